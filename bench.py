@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+from typing import Callable, Dict, List, Optional
+
+import argparse
+import json
+import math
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+try:
+    import numpy as np
+except ImportError:  # Only needed for the batch benchmark
+    np = None
+
+from tictactoe import BatchComputer, BitGrid, Grid, TTTComputer
+from verify import PositionVerifier
+
+class SetAlgebraComputer(TTTComputer):
+    '''TTTComputer with its heuristics computed by set algebra, as before the line
+       counts; the reference they are tested and benchmarked against.'''
+    triples = [set(line) for line in TTTComputer.lines]
+    def _try_to_win(self, grid_str: str, with_mark: str) -> Optional[int]:
+        my_marks = {idx for idx, what in enumerate(grid_str) if what == with_mark}
+        winning_moves = [(triple - (triple & my_marks)).pop() for triple in self.triples
+                         if len(triple & my_marks) == 2]
+        empty_winning_moves = [move for move in winning_moves if grid_str[move] == " "]
+        return empty_winning_moves[0] if empty_winning_moves else None
+    def _try_to_avoid_loss(self, grid_str: str, vs_mark: str) -> List[int]:
+        vs_marks = {idx for idx, what in enumerate(grid_str) if what == vs_mark}
+        avoid_loss_moves = [(triple - (triple & vs_marks)).pop() for triple in self.triples
+                            if len(triple & vs_marks) == 2]
+        return [move for move in avoid_loss_moves if grid_str[move] == " "]
+    def _detect_fork_move_for_mark(self, grid_str: str, mark: str, other_mark: str) -> List[int]:
+        marks = {idx for idx, what in enumerate(grid_str) if what == mark}
+        other_marks = {idx for idx, what in enumerate(grid_str) if what == other_mark}
+        intersecting_triples = [(triple, triple - marks) for triple in self.triples
+                                if triple & marks and not triple & other_marks]
+        return list({(a & available).pop()
+                     for triple, available in intersecting_triples
+                     for t, a in intersecting_triples
+                     if triple != t and a & available})
+
+def _grid_after(moves: List[str], markers: str = "XO") -> Grid:
+    grid = Grid(markers)
+    for move in moves:
+        grid.play(move)
+    return grid
+
+def _full_game() -> None:
+    grid = Grid()
+    computer = TTTComputer()
+    marks = ("X", "O")
+    turn = 0
+    while grid.get_winning_player() is None and not grid.is_full():
+        computer.play_on_grid(grid, marks[turn % 2], marks[(turn + 1) % 2])
+        turn += 1
+
+def _exhaustive_tree(grid: Grid) -> int:
+    '''Counts every complete game from grid, walking depth-first with undo.'''
+    if grid.get_winning_player() is not None or grid.is_full():
+        return 1
+    games = 0
+    for idx in range(9):
+        if grid.play_index(idx) is not None:
+            games += _exhaustive_tree(grid)
+            grid.undo()
+    return games
+
+def make_benchmarks() -> Dict[str, Callable[[], object]]:
+    '''Each benchmark is a callable timed as one operation.'''
+    computer = TTTComputer()
+    grids = [(_grid_after(moves), with_mark, vs_mark) for moves, with_mark, vs_mark in (
+        ([], "X", "O"),
+        (['top_left', 'top_right', 'bottom_left', 'bottom_right'], "X", "O"),  # Win
+        (['top_right', 'top_left', 'bottom_middle', 'middle_left'], "X", "O"),  # Block
+        (['top_left', 'top_middle', 'center', 'bottom_right'], "X", "O"),  # Fork
+        (['center', 'top_left', 'bottom_right'], "O", "X"),  # Block fork
+    )]
+    positions = [(grid.get_grid(), with_mark, vs_mark) for grid, with_mark, vs_mark in grids]
+    half_grid = _grid_after(['center', 'top_left', 'bottom_right', 'top_right'])
+    won_grid = _grid_after(['top_left', 'top_right', 'middle_left', 'middle_right', 'bottom_left'])
+    all_moves = list(Grid.textual_positions)
+    def play_all(grid_class: type = Grid) -> None:
+        grid = grid_class()
+        for move in all_moves:
+            grid.play(move)
+    def play_on_grid(computer: TTTComputer) -> None:
+        for grid, with_mark, vs_mark in grids:
+            computer.play_on_grid(grid, with_mark, vs_mark)
+            grid.undo()
+    set_algebra_computer = SetAlgebraComputer()
+    benchmarks = {
+        "grid_construction": Grid,
+        "grid_play_9": play_all,
+        "grid_get_grid": half_grid.get_grid,
+        "grid_get_winning_player": won_grid.get_winning_player,
+        "bitgrid_construction": BitGrid,
+        "bitgrid_play_9": lambda: play_all(BitGrid),
+        "computer_try_to_win": lambda: [computer._try_to_win(grid_s, with_mark)
+                                        for grid_s, with_mark, vs_mark in positions],
+        "computer_try_to_avoid_loss": lambda: [computer._try_to_avoid_loss(grid_s, vs_mark)
+                                               for grid_s, with_mark, vs_mark in positions],
+        "computer_detect_fork": lambda: [computer._detect_fork_move_for_mark(grid_s, with_mark, vs_mark)
+                                         for grid_s, with_mark, vs_mark in positions],
+        "computer_play_on_grid": lambda: play_on_grid(computer),
+        "computer_play_on_grid_set_algebra": lambda: play_on_grid(set_algebra_computer),
+        "full_game": _full_game,
+        "exhaustive_tree": lambda: _exhaustive_tree(Grid()),
+    }
+    if np is not None:  # Moves for every position a game can reach, in one call
+        batch_computer = BatchComputer()
+        cells = BatchComputer.encode(grid.get_grid() for grid in PositionVerifier.iter_positions())
+        benchmarks["batch_computer_moves_5478"] = lambda: batch_computer.moves(cells)
+    return benchmarks
+
+def instance_bytes(factory: Callable[[], object], count: int = 1000) -> float:
+    '''Memory allocated per object made by factory, averaged over count.'''
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        objects = [factory() for _ in range(count)]
+        allocated = tracemalloc.get_traced_memory()[0] - before - sys.getsizeof(objects)
+    finally:
+        tracemalloc.stop()
+    return allocated / count
+
+def make_constructors() -> Dict[str, Callable[[], object]]:
+    '''Objects made by the million, whose size is reported beside the timings.'''
+    return {"grid": Grid, "bitgrid": BitGrid}
+
+def run_benchmark(function: Callable[[], object], repeats: int, min_time: float,
+                  warmup: int) -> Dict[str, float]:
+    '''Times 'repeats' runs of a loop calibrated to last at least min_time,
+       after 'warmup' untimed calls; statistics are nanoseconds per call.'''
+    for _ in range(warmup):
+        function()
+    loops = 1
+    while True:  # Calibrate
+        start = time.perf_counter_ns()
+        for _ in range(loops):
+            function()
+        elapsed = time.perf_counter_ns() - start
+        if elapsed >= min_time * 1e9:
+            break
+        loops *= 2 if elapsed == 0 else max(2, min(10, int(min_time * 1e9 / elapsed) + 1))
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter_ns()
+        for _ in range(loops):
+            function()
+        samples.append((time.perf_counter_ns() - start) / loops)
+    return {"loops": loops, "repeats": repeats,
+            "min_ns": min(samples), "median_ns": statistics.median(samples),
+            "mean_ns": statistics.mean(samples),
+            "stdev_ns": statistics.stdev(samples) if len(samples) > 1 else 0.0}
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+            threshold: float, name_filter: str = "") -> List[str]:
+    '''Returns the names of benchmarks whose median is slower than the baseline's
+       by more than threshold (a fraction), and of those in the baseline that
+       match name_filter but are missing from results.'''
+    regressions = []
+    missing = [name for name in baseline if name_filter in name and name not in results]
+    width = max(map(len, list(results) + missing), default=0)
+    for name, result in results.items():
+        if name not in baseline:
+            print("%-*s %12.0f ns  (not in baseline)" % (width, name, result["median_ns"]))
+            continue
+        baseline_ns = baseline[name]["median_ns"]
+        if baseline_ns > 0:
+            ratio = result["median_ns"] / baseline_ns
+        else:  # A zero baseline can only be matched
+            ratio = 1.0 if result["median_ns"] <= 0 else math.inf
+        regressed = ratio > 1 + threshold
+        print("%-*s %12.0f ns  baseline %12.0f ns  %+7.1f%%%s"
+              % (width, name, result["median_ns"], baseline_ns, 100 * (ratio - 1),
+                 "  REGRESSION" if regressed else ""))
+        if regressed:
+            regressions.append(name)
+    for name in missing:  # Renamed, removed, or not importable here
+        print("%-*s %12s     baseline %12.0f ns  MISSING"
+              % (width, name, "-", baseline[name]["median_ns"]))
+    return regressions + missing
+
+def compare_sizes(sizes: Dict[str, float], baseline: Dict[str, float], threshold: float) -> List[str]:
+    '''Returns the names of objects now larger than in the baseline by more than
+       threshold (a fraction). Sizes depend on the Python version, so baselines
+       are only meaningful for the one they were saved with.'''
+    grown = []
+    width = max(map(len, sizes), default=0)
+    for name, size in sizes.items():
+        if name not in baseline:
+            continue
+        regressed = size > baseline[name] * (1 + threshold)
+        print("%-*s %12.0f bytes  baseline %12.0f bytes%s"
+              % (width, name, size, baseline[name], "  REGRESSION" if regressed else ""))
+        if regressed:
+            grown.append(name)
+    return grown
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the TicTacToe engine.")
+    parser.add_argument("--filter", default="", help="only run benchmarks containing this")
+    parser.add_argument("--repeats", type=int, default=7)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--min-time", type=float, default=0.1, help="seconds per timed run")
+    parser.add_argument("--save", metavar="PATH", help="save results as a JSON baseline")
+    parser.add_argument("--compare", metavar="PATH", help="fail on regressions against a baseline")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="allowed slowdown before failing, as a fraction")
+    args = parser.parse_args(argv)
+
+    results = {}
+    benchmarks = make_benchmarks()
+    width = max(map(len, benchmarks))
+    for name, function in benchmarks.items():
+        if args.filter not in name:
+            continue
+        results[name] = run_benchmark(function, args.repeats, args.min_time, args.warmup)
+        if not args.compare:
+            print("%-*s %12.0f ns  (min %.0f, stdev %.0f, %d x %d loops)"
+                  % (width, name, results[name]["median_ns"], results[name]["min_ns"],
+                     results[name]["stdev_ns"], results[name]["repeats"], results[name]["loops"]))
+    sizes = {name: instance_bytes(factory) for name, factory in make_constructors().items()}
+    if not args.compare:
+        for name, size in sizes.items():
+            print("%-*s %12.0f bytes per instance" % (width, name, size))
+    if args.save:
+        with open(args.save, "w") as baseline_file:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                       "benchmarks": results, "bytes_per_instance": sizes},
+                      baseline_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline["benchmarks"], args.threshold, args.filter)
+        regressions += compare_sizes(sizes, baseline.get("bytes_per_instance", {}), args.threshold)
+        if regressions:
+            print("%d benchmark(s) regressed by more than %.0f%% or missing: %s"
+                  % (len(regressions), 100 * args.threshold, ", ".join(regressions)))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
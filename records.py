@@ -0,0 +1,113 @@
+from typing import List, Tuple, Iterable, Iterator, Sequence
+
+import mmap
+
+from tictactoe import BitGrid, Grid, InvalidMarkers
+
+class GameRecordWriter:
+    '''Appends finished games to an archive of fixed-size records: the two
+       marker characters (one byte each), then up to 9 moves as 4-bit
+       position indices packed high nibble first, padded with 0xF.'''
+    magic = b"TTT\x01"
+    record_size = 7
+    def __init__(self, path: str) -> None:
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(self.magic)
+    def __enter__(self) -> 'GameRecordWriter':
+        return self
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+    def close(self) -> None:
+        self.file.close()
+    @classmethod
+    def encode(cls, markers: str, moves: Sequence[int]) -> bytes:
+        if len(markers) != 2 or markers[0] == markers[1]:
+            raise InvalidMarkers()
+        try:
+            header = markers.encode("latin-1")
+        except UnicodeEncodeError:
+            raise InvalidMarkers()
+        if len(moves) > 9 or len(set(moves)) != len(moves) or not all(0 <= move < 9 for move in moves):
+            raise ValueError("Invalid moves %r" % (moves,))
+        nibbles = list(moves) + [0xF] * (10 - len(moves))
+        return header + bytes(nibbles[i] << 4 | nibbles[i+1] for i in range(0, 10, 2))
+    @staticmethod
+    def moves_of(grid: Grid) -> List[int]:
+        '''Moves of a Grid in the order played.'''
+        return [Grid.textual_positions.index(posn) for posn in grid.played_positions]
+    def write(self, markers: str, moves: Sequence[int]) -> None:
+        self.file.write(self.encode(markers, moves))
+    def write_many(self, games: Iterable[Tuple[str, Sequence[int]]]) -> int:
+        '''Writes (markers, moves) games in a single write; returns how many.'''
+        records = bytearray()
+        for markers, moves in games:
+            records += self.encode(markers, moves)
+        self.file.write(records)
+        return len(records) // self.record_size
+
+class GameRecordReader:
+    '''Memory-maps an archive written by GameRecordWriter and decodes records
+       lazily, so archives need not fit in memory.'''
+    outcomes = ('first', 'second', 'draw', 'unfinished')
+    _nibbles = [(byte >> 4, byte & 0xF) for byte in range(256)]
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as archive:
+            self.map = mmap.mmap(archive.fileno(), 0, access=mmap.ACCESS_READ)
+        header_size = len(GameRecordWriter.magic)
+        if self.map[:header_size] != GameRecordWriter.magic:
+            self.map.close()
+            raise ValueError("Not a game record archive: %s" % path)
+        if (len(self.map) - header_size) % GameRecordWriter.record_size:
+            self.map.close()
+            raise ValueError("Truncated game record archive: %s" % path)
+        self._start = header_size
+    def __enter__(self) -> 'GameRecordReader':
+        return self
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+    def close(self) -> None:
+        self.map.close()
+    def __len__(self) -> int:
+        return (len(self.map) - self._start) // GameRecordWriter.record_size
+    def __iter__(self) -> Iterator[Tuple[str, Tuple[int, ...]]]:
+        '''Yields (markers, moves) for each record in turn; raises ValueError at a
+           record GameRecordWriter could not have written.'''
+        data, nibbles = self.map, self._nibbles
+        for offset in range(self._start, len(data), GameRecordWriter.record_size):
+            markers = data[offset:offset+2].decode("latin-1")
+            moves = []  # type: List[int]
+            for byte in data[offset+2:offset+GameRecordWriter.record_size]:
+                moves.extend(nibbles[byte])
+            played = moves.index(0xF) if 0xF in moves else -1
+            if (played < 0 or any(nibble != 0xF for nibble in moves[played:])
+                    or any(move > 8 for move in moves[:played])
+                    or len(set(moves[:played])) != played or markers[0] == markers[1]):
+                raise ValueError("Corrupt game record at offset %d" % offset)
+            yield markers, tuple(moves[:played])
+    def grids(self) -> Iterator[Grid]:
+        '''Yields each game replayed into a Grid.'''
+        for markers, moves in self:
+            grid = Grid(markers)
+            for move in moves:
+                grid.play(Grid.textual_positions[move])
+            yield grid
+    @staticmethod
+    def outcome(moves: Sequence[int]) -> str:
+        '''Outcome of a game without building a Grid; a win by the first player
+           takes precedence, as in Grid.get_winning_player.'''
+        bits = [0, 0]
+        for turn, move in enumerate(moves):
+            bits[turn % 2] |= 1 << move
+        for player, name in enumerate(('first', 'second')):
+            if any(bits[player] & mask == mask for mask in BitGrid.winning_masks):
+                return name
+        return 'draw' if len(moves) == 9 else 'unfinished'
+    def filter(self, *outcomes: str) -> Iterator[Tuple[str, Tuple[int, ...]]]:
+        '''Yields (markers, moves) for games with one of the given outcomes.'''
+        for outcome in outcomes:
+            if outcome not in self.outcomes:
+                raise ValueError("Unknown outcome %r" % outcome)
+        for markers, moves in self:
+            if self.outcome(moves) in outcomes:
+                yield markers, moves
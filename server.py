@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+from typing import Optional, List, Dict, Set
+from collections import deque
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+
+from tictactoe import Grid, InvalidMarkers, TTTComputer
+
+class GameSession:
+    __slots__ = ('grid', 'human_mark', 'computer_mark', 'last_active')
+    def __init__(self, grid: Grid, human_mark: str, computer_mark: str, now: float) -> None:
+        self.grid = grid
+        self.human_mark = human_mark
+        self.computer_mark = computer_mark
+        self.last_active = now
+
+class GameServer:
+    '''asyncio TCP server hosting human-vs-computer sessions, one JSON object per
+       line in each direction. Requests are handled in order per connection and
+       the next line is only read once the response has drained, so a slow
+       client cannot make the server buffer without bound. A session can only
+       be played or ended over the connection that created it, and is removed
+       when that connection closes.'''
+    def __init__(self, computer: Optional[TTTComputer] = None, idle_timeout: float = 300.0,
+                 max_sessions: int = 100000, max_line: int = 4096) -> None:
+        self.computer = computer or TTTComputer(cache_size=10000)
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.max_line = max_line
+        self.sessions = {}  # type: Dict[int, GameSession]
+        self._session_ids = itertools.count(1)
+        self._server = None  # type: Optional[asyncio.AbstractServer]
+        self._sweeper = None  # type: Optional[asyncio.Task]
+        self._writers = set()  # type: Set[asyncio.StreamWriter]
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        '''Starts listening and sweeping idle sessions; returns the bound port.'''
+        self._server = await asyncio.start_server(self._handle_connection, host, port,
+                                                  limit=self.max_line)
+        self._sweeper = asyncio.ensure_future(self._sweep_idle_sessions())
+        return self._server.sockets[0].getsockname()[1]
+    async def close(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._writers):  # Else wait_closed waits for clients to leave
+                writer.close()
+            await self._server.wait_closed()
+    def evict_idle(self, now: Optional[float] = None) -> int:
+        '''Removes sessions idle for longer than idle_timeout; returns how many.'''
+        cutoff = (time.monotonic() if now is None else now) - self.idle_timeout
+        idle = [session_id for session_id, session in self.sessions.items()
+                if session.last_active < cutoff]
+        for session_id in idle:
+            del self.sessions[session_id]
+        return len(idle)
+    async def _sweep_idle_sessions(self) -> None:
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2)
+            self.evict_idle()
+    async def _handle_connection(self, reader: asyncio.StreamReader,
+                                 writer: asyncio.StreamWriter) -> None:
+        owned = set()  # type: Set[int]
+        self._writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    response = {"ok": False, "error": "invalid json"}
+                else:
+                    try:
+                        response = self.handle_request(request, owned)
+                    except Exception:  # Reply rather than drop the connection
+                        logging.exception("Error handling request %r", request)
+                        response = {"ok": False, "error": "internal error"}
+                    if isinstance(request, dict) and "id" in request:
+                        response["id"] = request["id"]
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass  # Client went away, or sent an over-long line
+        finally:
+            for session_id in owned:
+                self.sessions.pop(session_id, None)
+            self._writers.discard(writer)
+            writer.close()
+    def handle_request(self, request, owned: Set[int]) -> dict:
+        '''Answers one request from a client owning the sessions in owned, which
+           a new session is added to.'''
+        if not isinstance(request, dict):
+            return {"ok": False, "error": "request must be an object"}
+        op = request.get("op")
+        if op == "new":
+            return self._new_session(request, owned)
+        if op not in ("play", "end"):
+            return {"ok": False, "error": "unknown op"}
+        session_id = request.get("session")
+        session = None
+        if type(session_id) is int and session_id in owned:  # Not bool
+            session = self.sessions.get(session_id)
+            if session is None:  # Evicted while idle
+                owned.discard(session_id)
+        if session is None:
+            return {"ok": False, "error": "unknown session"}
+        if op == "end":
+            del self.sessions[session_id]
+            owned.discard(session_id)
+            return {"ok": True}
+        session.last_active = time.monotonic()
+        grid = session.grid
+        if grid.get_winning_player() is not None or grid.is_full():
+            return self._state(session_id, session, error="game over")
+        if not isinstance(request.get("position"), str) or grid.play(request["position"]) is None:
+            return self._state(session_id, session, error="invalid move")
+        if grid.get_winning_player() is None and not grid.is_full():
+            self.computer.play_on_grid(grid, session.computer_mark, session.human_mark)
+        return self._state(session_id, session)
+    def _new_session(self, request: dict, owned: Set[int]) -> dict:
+        if len(self.sessions) >= self.max_sessions:
+            return {"ok": False, "error": "server busy"}
+        markers = request.get("markers", "XO")
+        if not isinstance(markers, str) or len(markers) != 2 or " " in markers:
+            return {"ok": False, "error": "invalid markers"}  # Blank marks would read as empty
+        try:
+            grid = Grid(markers)
+        except InvalidMarkers:
+            return {"ok": False, "error": "invalid markers"}
+        computer_first = request.get("computer_first", False)
+        if not isinstance(computer_first, bool):
+            return {"ok": False, "error": "invalid computer_first"}
+        human_mark, computer_mark = grid.markers[::-1] if computer_first else grid.markers
+        session_id = next(self._session_ids)
+        session = GameSession(grid, human_mark, computer_mark, time.monotonic())
+        self.sessions[session_id] = session
+        owned.add(session_id)
+        if computer_first:
+            self.computer.play_on_grid(grid, computer_mark, human_mark)
+        return self._state(session_id, session)
+    @staticmethod
+    def _state(session_id: int, session: GameSession, error: Optional[str] = None) -> dict:
+        state = {"ok": error is None, "session": session_id, "grid": session.grid.get_grid(),
+                 "mark": session.human_mark, "winner": session.grid.get_winning_player(),
+                 "full": session.grid.is_full()}
+        if error is not None:
+            state["error"] = error
+        return state
+
+class _PipelinedConnection:
+    '''Client connection that may have many requests in flight; the server
+       answers each connection's requests in order.'''
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.pending = deque()  # type: deque
+        self.receiver = asyncio.ensure_future(self._receive())
+    async def _receive(self) -> None:
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+            self.pending.popleft().set_result(json.loads(line))
+        for future in self.pending:
+            future.set_exception(ConnectionError("connection closed"))
+    async def request(self, message: dict) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(future)
+        self.writer.write(json.dumps(message).encode() + b"\n")
+        await self.writer.drain()
+        return await future
+    async def close(self) -> None:
+        self.writer.close()
+        await self.receiver
+
+class GameLoadGenerator:
+    '''Plays many concurrent sessions against a GameServer, pipelined over a
+       fixed number of connections, timing each human move until the
+       computer's reply arrives.'''
+    def __init__(self, host: str, port: int, sessions: int = 10000,
+                 connections: int = 100, seed: int = 0) -> None:
+        self.host = host
+        self.port = port
+        self.sessions = sessions
+        self.connections = connections
+        self.random = random.Random(seed)
+        self.latencies = []  # type: List[float]
+        self.errors = 0
+    async def run(self) -> Dict[str, float]:
+        connections = []
+        for _ in range(min(self.connections, self.sessions)):
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            connections.append(_PipelinedConnection(reader, writer))
+        start_time = time.perf_counter()
+        await asyncio.gather(*(self._play_session(connections[idx % len(connections)])
+                               for idx in range(self.sessions)))
+        seconds = time.perf_counter() - start_time
+        for connection in connections:
+            await connection.close()
+        return self.report(seconds)
+    async def _play_session(self, connection: _PipelinedConnection) -> None:
+        state = await connection.request({"op": "new"})
+        if not state["ok"]:
+            self.errors += 1
+            return
+        while state["winner"] is None and not state["full"]:
+            empty = [idx for idx, entry in enumerate(state["grid"]) if entry == " "]
+            move_start = time.perf_counter()
+            state = await connection.request({"op": "play", "session": state["session"],
+                                              "position": Grid.textual_positions[self.random.choice(empty)]})
+            self.latencies.append(time.perf_counter() - move_start)
+            if not state["ok"]:
+                self.errors += 1
+                return
+        await connection.request({"op": "end", "session": state["session"]})
+    def report(self, seconds: float) -> Dict[str, float]:
+        latencies = sorted(self.latencies)
+        def percentile(fraction: float) -> float:
+            return 1000 * latencies[int(fraction * (len(latencies) - 1))] if latencies else 0.0
+        return {"sessions": self.sessions, "moves": len(latencies), "errors": self.errors,
+                "seconds": seconds, "moves_per_second": len(latencies) / seconds if seconds else 0.0,
+                "p50_ms": percentile(0.50), "p99_ms": percentile(0.99)}
+
+async def serve(args: argparse.Namespace) -> None:
+    server = GameServer(idle_timeout=args.idle_timeout, max_sessions=args.max_sessions)
+    port = await server.start(args.host, args.port)
+    print("Serving on %s:%d" % (args.host, port))
+    try:
+        await asyncio.Event().wait()  # Until interrupted
+    finally:
+        await server.close()
+
+async def load(args: argparse.Namespace) -> None:
+    generator = GameLoadGenerator(args.host, args.port, args.sessions, args.connections, args.seed)
+    report = await generator.run()
+    print("%(sessions)d sessions, %(moves)d moves, %(errors)d errors in %(seconds).2fs: "
+          "%(moves_per_second).0f moves/s, p50 %(p50_ms).2fms, p99 %(p99_ms).2fms" % report)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve TicTacToe games over line-delimited JSON.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="run the game server")
+    serve_parser.add_argument("--idle-timeout", type=float, default=300.0)
+    serve_parser.add_argument("--max-sessions", type=int, default=100000)
+    load_parser = commands.add_parser("load", help="measure move latency against a running server")
+    load_parser.add_argument("--sessions", type=int, default=10000)
+    load_parser.add_argument("--connections", type=int, default=100)
+    load_parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args) if args.command == "serve" else load(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
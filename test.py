@@ -1,60 +1,30 @@
 #!/usr/bin/env python3
 
-from typing import Optional, List
+from typing import List, Set, Tuple
 
+import asyncio
+import contextlib
+import dis
+import io
+import json
+import os
+import tempfile
+import time
+import tracemalloc
 import unittest
 
-class InvalidMarkers(Exception):
-    pass
-
-class Grid:
-    textual_positions = ['top_left', 'top_middle', 'top_right',
-                         'middle_left', 'center', 'middle_right',
-                         'bottom_left', 'bottom_middle', 'bottom_right']
-    def __init__(self, markers: str = "XO") -> None:
-        if len(markers) != 2:
-            raise InvalidMarkers()
-        if markers[0] == markers[1]:
-            raise InvalidMarkers()
-        self.played_positions = dict()
-        self.markers = markers
-    def is_empty(self) -> bool:
-        return len(self.played_positions) == 0
-    def is_full(self) -> bool:
-        return len(self.played_positions) == 9
-    def get_grid(self) -> str:
-        if self.is_empty():
-            return " "*9
-        return "".join(self.played_positions[posn]
-                           if posn in self.played_positions else " "
-                       for posn in self.textual_positions)
-    def __str__(self) -> str:
-        return self.get_grid()
-    def play(self, position: str) -> Optional[str]:
-        if position in self.played_positions:
-            return None
-        if position not in self.textual_positions:
-            return None
-        marker = self.markers[len(self.played_positions)%2]
-        self.played_positions[position] = marker
-        return marker
-    def get_winning_player(self) -> Optional[str]:
-        if self.is_empty() or len(self.played_positions) < 5:
-            return None
-        winning_lines = [{'top_left', 'middle_left', 'bottom_left'},  # Down
-                         {'top_middle', 'center', 'bottom_middle'},
-                         {'top_right', 'middle_right', 'bottom_right'},
-                         {'top_left', 'top_middle', 'top_right'},  # Across
-                         {'middle_left', 'center', 'middle_right'},
-                         {'bottom_left', 'bottom_middle', 'bottom_right'},
-                         {'top_left', 'center', 'bottom_right'},  # Diagonal
-                         {'top_right', 'center', 'bottom_left'},
-        ]
-        for marker in self.markers:
-            positions = {k for k, v in self.played_positions.items() if v is marker}
-            if len([line for line in winning_lines if positions.issuperset(line)]):
-                return marker
-        return None
+try:
+    import numpy as np
+except ImportError:  # Only needed for the batch tests
+    np = None
+
+from tictactoe import (BatchComputer, BatchGrid, BitGrid, DecisionStats, Grid, InvalidMarkers,
+                       MNKGrid, PerfectPlayTable, SearchComputer, TTTComputer)
+from bench import SetAlgebraComputer
+from records import GameRecordReader, GameRecordWriter
+from server import GameLoadGenerator, GameServer
+from tournament import RandomPlayer, Tournament
+from verify import PositionVerifier
 
 class TicTacToeTest(unittest.TestCase):
     player_1 = "X"
@@ -115,6 +85,19 @@ class TicTacToeTest(unittest.TestCase):
         for move in moves:
             self.grid.play(move)
         self.assertEqual(self.grid.get_winning_player(), None)
+    def test_winner_known_as_soon_as_winning_move_played(self):
+        moves = ['top_left', 'top_right', 'middle_left', 'middle_right']
+        for move in moves:
+            self.grid.play(move)
+            self.assertEqual(self.grid.get_winning_player(), None)
+        self.grid.play('bottom_left')
+        self.assertEqual(self.grid.get_winning_player(), self.player_1)
+    def test_first_player_preferred_when_both_have_won(self):
+        moves = ['top_left', 'middle_left', 'top_middle', 'center',
+                 'top_right', 'middle_right']  # Play continues after first win
+        for move in moves:
+            self.grid.play(move)
+        self.assertEqual(self.grid.get_winning_player(), self.player_1)
 
     def _make_plays(self, first_moves, second_moves, grid=None):
         if grid is None:
@@ -246,83 +229,250 @@ class TicTacToeTest_star_plus(TicTacToeTest):  # Demonstration of arbitrary mark
     def make_grid(self):
         return Grid("*+")
 
-class TTTComputer:
-    def __init__(self):
-        self.triples = [ {0, 4, 8}, {2, 4, 6} ]  # Diagonals
-        for i in range(0,3):
-            self.triples.append({0+(3*i), 1+(3*i), 2+(3*i)})  # Horizontals
-            self.triples.append({0+i, 3+i, 6+i})  # Verticals
-    def play_on_grid(self, grid: Grid, with_mark: str, vs_mark: str) -> None:
-        grid_s = grid.get_grid()
-        number_of_plays = len([entry for entry in grid_s if entry is not " "])
-        # Try to win
-        winning_move = self._try_to_win(grid_s, with_mark)
-        if winning_move is not None:
-            grid.play(Grid.textual_positions[winning_move])
-            return
-        # Block any potential losing move
-        avoid_loss_move = self._try_to_avoid_loss(grid_s, vs_mark)
-        if avoid_loss_move:  # Non-empty list
-            grid.play(Grid.textual_positions[avoid_loss_move[0]])  # Might be forked, play anyhow
-            return
-        # Try to detect a fork for computer and play there
-        fork_move_for_me = self._detect_fork_move_for_mark(grid_s, with_mark, vs_mark)
-        if fork_move_for_me:  # Non-empty list
-            grid.play(Grid.textual_positions[fork_move_for_me[0]])
-            return
-        # Try to detect a fork for opponent and play (block) there
-        fork_move_for_opponent = self._detect_fork_move_for_mark(grid_s, vs_mark, with_mark)
-        if fork_move_for_opponent:  # Non-empty list
-            grid.play(Grid.textual_positions[fork_move_for_opponent[0]])
-            return
-        # If center is not taken, take it, except on first move
-        if number_of_plays > 0 and grid_s[4] == " ":
-            grid.play('center')
-            return
-        # Play in next available space
-        for sequential_move in range(0, 9):
-            if grid_s[sequential_move] == " ":
-                grid.play(Grid.textual_positions[sequential_move])
-                return
-        return
-    def _try_to_win(self, grid_str: str, with_mark: str) -> Optional[int]:
-        '''Tries to find a move to win; if so, returns index, otherwise None.'''
-        my_marks = {idx for idx, what in enumerate(grid_str) if what is with_mark}
-        # We know we have one entry, so using pop is safe (triple less length=2 item)
-        winning_moves = [(triple - (triple & my_marks)).pop() for triple in self.triples
-                         if len(triple & my_marks) == 2]
-        if winning_moves:
-            empty_winning_moves = [move for move in winning_moves if grid_str[move] == " "]
-            if empty_winning_moves:
-                assert(len(empty_winning_moves)==1)  # FIXME? Previous code assumed this
-                return empty_winning_moves[0]
-        return None
-    def _try_to_avoid_loss(self, grid_str: str, vs_mark: str) -> List[int]:
-        '''Tries to find if a position must be played to block an opponent's win.
-           If so, returns that index, otherwise None.'''
-        vs_marks = {idx for idx, what in enumerate(grid_str) if what is vs_mark}
-        # We know we have one entry, so using pop is safe (triple less length=2 item)
-        avoid_loss_moves = [(triple - (triple & vs_marks)).pop() for triple in self.triples
-                            if len(triple & vs_marks) == 2]
-        if avoid_loss_moves:
-            empty_avoid_loss_moves = [move for move in avoid_loss_moves if grid_str[move] == " "]
-            if empty_avoid_loss_moves:
-                return empty_avoid_loss_moves
-        return []
-    def _detect_fork_move_for_mark(self, grid_str: str, mark: str, other_mark: str) -> List[int]:
-        '''Tries to find if a position exists where 'mark' can fork.
-           If so, returns that index, otherwise None.'''
-        marks = {idx for idx, what in enumerate(grid_str) if what is mark}
-        other_marks = {idx for idx, what in enumerate(grid_str) if what is other_mark}
-        intersecting_triples = [(triple, triple & marks, triple - marks) for triple in self.triples
-                                if (triple & marks) != set() and triple & other_marks == set()]
-        forks = {(a & available).pop()  # Can pop since not an empty set
-                 for triple, overlap, available in intersecting_triples
-                 for t, o, a in intersecting_triples
-                 if triple != t and (a & available) != set()}
-        if forks:
-            return list(forks)
-        return []
+class GridConstantsTest(unittest.TestCase):  # Not inherited, so run once
+    def test_lines_through_position_match_winning_lines(self):
+        for posn, lines in Grid.lines_through_position.items():
+            self.assertEqual(lines, tuple(idx for idx, line in enumerate(Grid.winning_lines)
+                                          if posn in line), posn)
+
+class BitGridTest(TicTacToeTest):
+    def make_grid(self):
+        return BitGrid()
+
+    def test_bitgrid_too_few_markers(self):
+        with self.assertRaises(InvalidMarkers):
+            grid = BitGrid("O")
+    def test_bitgrid_duplicate_markers(self):
+        with self.assertRaises(InvalidMarkers):
+            grid = BitGrid("OO")
+    def test_bitgrid_has_no_instance_dict(self):
+        self.assertFalse(hasattr(self.grid, '__dict__'))
+    def test_play_index_matches_textual_play(self):
+        for idx, move in enumerate(BitGrid.textual_positions):
+            textual_grid = self.make_grid()
+            textual_grid.play(move)
+            self.assertEqual(self.grid.play_index(idx), textual_grid.get_grid()[idx])
+            self.assertEqual(self.grid.get_grid()[idx], textual_grid.get_grid()[idx])
+            self.grid = self.make_grid()
+    def test_play_index_twice_fails(self):
+        self.assertIsNotNone(self.grid.play_index(4))
+        self.assertIsNone(self.grid.play_index(4))
+    def test_bad_play_index(self):
+        self.assertIsNone(self.grid.play_index(-1))
+        self.assertIsNone(self.grid.play_index(9))
+        self.assertTrue(self.grid.is_empty())
+    def test_same_grid_as_dict_grid_for_many_games(self):
+        for offset in range(9):
+            moves = [Grid.textual_positions[(offset + 4*i) % 9] for i in range(9)]
+            grid, bit_grid = Grid(self.grid.markers), BitGrid(self.grid.markers)
+            for move in moves:
+                self.assertEqual(bit_grid.play(move), grid.play(move), move)
+                self.assertEqual(bit_grid.get_grid(), grid.get_grid(), move)
+                self.assertEqual(bit_grid.get_winning_player(), grid.get_winning_player(), move)
+
+class BitGridTest_OX(BitGridTest):
+    player_1 = "O"
+    player_2 = "X"
+    def make_grid(self):
+        return BitGrid("OX")
+
+class BitGridTest_star_plus(BitGridTest):
+    player_1 = "*"
+    player_2 = "+"
+    def make_grid(self):
+        return BitGrid("*+")
+
+class GridUndoTest(unittest.TestCase):
+    def make_grid(self):
+        return Grid()
+    def position(self, idx: int):
+        '''What undo returns for the move at idx.'''
+        return Grid.textual_positions[idx]
+
+    def setUp(self):
+        self.grid = self.make_grid()
+    def test_nothing_to_undo_or_redo(self):
+        self.assertIsNone(self.grid.undo())
+        self.assertIsNone(self.grid.redo())
+    def test_undo_restores_empty_grid(self):
+        self.grid.play_index(4)
+        self.assertEqual(self.grid.undo(), self.position(4))
+        self.assertTrue(self.grid.is_empty())
+        self.assertEqual(self.grid.get_grid(), " "*9)
+        self.assertEqual(self.grid.play_index(4), "X")
+    def test_undo_and_redo_winning_move(self):
+        for idx in (0, 3, 1, 4, 2):
+            self.grid.play_index(idx)
+        self.assertEqual(self.grid.get_winning_player(), "X")
+        self.assertEqual(self.grid.undo(), self.position(2))
+        self.assertIsNone(self.grid.get_winning_player())
+        self.assertEqual(self.grid.redo(), "X")
+        self.assertEqual(self.grid.get_winning_player(), "X")
+        self.assertIsNone(self.grid.redo())
+    def test_redo_in_order_after_several_undos(self):
+        for idx in (4, 0, 8):
+            self.grid.play_index(idx)
+        expected = self.grid.get_grid()
+        self.assertEqual([self.grid.undo() for _ in range(3)], [self.position(idx) for idx in (8, 0, 4)])
+        self.assertEqual([self.grid.redo() for _ in range(3)], ["X", "O", "X"])
+        self.assertEqual(self.grid.get_grid(), expected)
+    def test_play_discards_undone_moves(self):
+        self.grid.play_index(4)
+        self.grid.play_index(0)
+        self.grid.undo()
+        self.assertEqual(self.grid.play_index(8), "O")
+        self.assertIsNone(self.grid.redo())
+        self.assertEqual(self.grid.get_grid(), "    X   O")
+    def _walk(self, depth: int) -> int:
+        '''Depth-first count of move sequences, on this one grid.'''
+        if depth == 0 or self.grid.get_winning_player() is not None or self.grid.is_full():
+            return 1
+        count = 0
+        for idx in range(9):
+            if self.grid.play_index(idx) is not None:
+                count += self._walk(depth - 1)
+                self.grid.undo()
+        return count
+    def _held_move_allocations(self) -> List[tracemalloc.Trace]:
+        '''Blocks allocated in the grid's play, undo or redo that are still held.'''
+        lines = set()
+        for method_name in ('play', 'play_index', 'undo', 'redo'):
+            method = getattr(type(self.grid), method_name, None)  # MNKGrid has no play
+            if method is not None:
+                code = method.__code__
+                lines.update((code.co_filename, line) for _, line in dis.findlinestarts(code))
+        snapshot = tracemalloc.take_snapshot()
+        return [trace for trace in snapshot.traces
+                if (trace.traceback[0].filename, trace.traceback[0].lineno) in lines]
+    def test_depth_first_walk_restores_grid(self):
+        self.assertEqual(self._walk(4), 9*8*7*6)
+        self.assertTrue(self.grid.is_empty())
+        tracemalloc.start()  # After a first walk, moves should allocate nothing more
+        try:
+            self.assertEqual(self._walk(4), 9*8*7*6)
+            self.assertEqual(self._held_move_allocations(), [])
+        finally:
+            tracemalloc.stop()
+        for idx in (4, 0, 1):
+            self.grid.play_index(idx)
+        self.assertEqual(self._walk(6), 473)  # Games completed from here, as counted on fresh grids
+        self.assertEqual(self.grid.get_grid(), "OX  X    ")
+        self.assertIsNone(self.grid.get_winning_player())
+
+class MNKGridUndoTest(GridUndoTest):
+    def make_grid(self):
+        return MNKGrid()
+    def position(self, idx: int):
+        return idx
+
+class MNKGridTest(unittest.TestCase):
+    def test_invalid_markers(self):
+        for markers in ("O", "OXY", "OO"):
+            with self.assertRaises(InvalidMarkers):
+                MNKGrid(3, 3, 3, markers)
+    def test_invalid_board(self):
+        for rows, columns, k in ((0, 3, 3), (3, 0, 3), (3, 3, 0), (3, 3, 4)):
+            with self.assertRaises(ValueError):
+                MNKGrid(rows, columns, k)
+    def test_grid_is_3_3_3_special_case(self):
+        self.assertEqual((Grid.rows, Grid.columns, Grid.k), (3, 3, 3))
+        for markers in ("XO", "OX", "*+"):
+            for offset in range(9):
+                for step in range(1, 9):
+                    grid, mnk_grid = Grid(markers), MNKGrid(3, 3, 3, markers)
+                    for turn in range(9):
+                        idx = (offset + step*turn) % 9
+                        self.assertEqual(mnk_grid.play_index(idx), grid.play_index(idx))
+                        self.assertEqual(mnk_grid.get_grid(), grid.get_grid())
+                        self.assertEqual(mnk_grid.is_full(), grid.is_full())
+                        self.assertEqual(mnk_grid.get_winning_player(), grid.get_winning_player())
+    def test_bad_and_repeated_play_index(self):
+        grid = MNKGrid(15, 15, 5)
+        self.assertIsNone(grid.play_index(-1))
+        self.assertIsNone(grid.play_index(15*15))
+        self.assertEqual(grid.play_index(grid.index(7, 7)), "X")
+        self.assertIsNone(grid.play_index(grid.index(7, 7)))
+        self.assertEqual(grid.get_grid().count(" "), 15*15 - 1)
+    def _play_line(self, start, step, length, rows=15, columns=15, k=5):
+        '''First player plays 'length' positions along a line; second plays far away.'''
+        grid = MNKGrid(rows, columns, k)
+        spare = iter(range(rows*columns - 1, -1, -2))  # Never in a row
+        row, column = start
+        for move in range(length):
+            grid.play_index(grid.index(row + move*step[0], column + move*step[1]))
+            if grid.play_index(next(spare)) is None:
+                raise AssertionError("Spare move collided with line")
+        return grid
+    def test_five_in_a_row_wins_in_each_direction(self):
+        for start, step in (((2, 3), (0, 1)), ((3, 2), (1, 0)),
+                            ((1, 1), (1, 1)), ((1, 9), (1, -1))):
+            self.assertIsNone(self._play_line(start, step, 4).get_winning_player(), step)
+            self.assertEqual(self._play_line(start, step, 5).get_winning_player(), "X", step)
+    def test_line_does_not_wrap_around_rows(self):
+        grid = MNKGrid(15, 15, 5)
+        for column in (12, 13, 14):
+            grid.play_index(grid.index(0, column))
+            grid.play_index(grid.index(10, column))
+        for column in (0, 1):
+            grid.play_index(grid.index(1, column))
+            grid.play_index(grid.index(11, column + 5))
+        self.assertIsNone(grid.get_winning_player())
+    def test_win_when_last_move_fills_middle_of_line(self):
+        grid = MNKGrid(7, 6, 4)
+        for column, spare in ((0, 30), (1, 31), (3, 32)):
+            grid.play_index(grid.index(2, column))
+            grid.play_index(spare)
+        self.assertIsNone(grid.get_winning_player())
+        grid.play_index(grid.index(2, 2))
+        self.assertEqual(grid.get_winning_player(), "X")
+    def test_full_board(self):
+        grid = MNKGrid(2, 3, 3)
+        for idx in range(6):
+            grid.play_index(idx)
+        self.assertTrue(grid.is_full())
+        self.assertEqual(grid.get_grid(), "XOXOXO")
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class BatchGridTest(unittest.TestCase):
+    markers = "XO"
+    def setUp(self):
+        # Each game plays positions offset, offset+step, ... (mod 9), with some repeats
+        self.games = [[(offset + step*i) % 9 for i in range(9)]
+                      for offset in range(9) for step in range(1, 9)]
+    def test_invalid_markers(self):
+        for markers in ("O", "OXY", "OO"):
+            with self.assertRaises(InvalidMarkers):
+                BatchGrid(1, markers)
+    def test_starts_empty_and_not_full(self):
+        batch = BatchGrid(3, self.markers)
+        self.assertTrue(batch.is_empty().all())
+        self.assertFalse(batch.is_full().any())
+        self.assertEqual(batch.get_grid(1), " "*9)
+    def test_rejects_bad_and_repeated_moves_per_grid(self):
+        batch = BatchGrid(4, self.markers)
+        self.assertEqual(batch.play([4, 4, -1, 9]).tolist(), [1, 1, 0, 0])
+        self.assertEqual(batch.play([4, 0, 4, 4]).tolist(), [0, 2, 1, 1])
+        self.assertEqual(batch.plays.tolist(), [1, 2, 1, 1])
+    def test_matches_grid_for_many_games(self):
+        batch = BatchGrid(len(self.games), self.markers)
+        grids = [Grid(self.markers) for game in self.games]
+        for turn in range(9):
+            played = batch.play([game[turn] for game in self.games])
+            winners = batch.get_winning_players()
+            for idx, (grid, game) in enumerate(zip(grids, self.games)):
+                marker = grid.play(Grid.textual_positions[game[turn]])
+                self.assertEqual(self.markers[played[idx] - 1] if played[idx] else None, marker)
+                self.assertEqual(batch.get_grid(idx), grid.get_grid())
+                self.assertEqual(batch.is_full()[idx], grid.is_full())
+                winner = grid.get_winning_player()
+                self.assertEqual(self.markers[winners[idx] - 1] if winners[idx] else None, winner)
+                self.assertEqual(batch.get_winning_player(idx), winner)
+
+class BatchGridTest_OX(BatchGridTest):
+    markers = "OX"
+
+class BatchGridTest_star_plus(BatchGridTest):
+    markers = "*+"
 
 class TTT_computer_test(unittest.TestCase):
     def setUp(self):
@@ -420,5 +570,784 @@ class TTT_computer_test(unittest.TestCase):
         self.assertNumberOfPlaysOnGrid(grid_str, 4)
         self.assertEqual(grid_str, "O O X   X")
 
+class TTT_instrumented_computer_test(TTT_computer_test):
+    def setUp(self):
+        self.stats = DecisionStats()
+        self.computer = TTTComputer(stats=self.stats)
+        self.grid = Grid("XO")
+
+    def test_first_move_tries_every_stage(self):
+        self.computer.play_on_grid(self.grid, "X", "O")
+        snapshot = self.stats.snapshot()
+        self.assertEqual(list(snapshot), ['win', 'block', 'fork', 'block_fork', 'center', 'sequential'])
+        self.assertEqual([counter["hits"] for counter in snapshot.values()], [0, 0, 0, 0, 0, 1])
+        self.assertTrue(all(counter["calls"] == 1 and counter["ns"] >= 0
+                            for counter in snapshot.values()))
+    def test_stages_after_hit_are_skipped(self):
+        for move in ('top_left', 'top_right', 'bottom_left', 'bottom_right'):
+            self.grid.play(move)
+        self.computer.play_on_grid(self.grid, "X", "O")
+        self.assertEqual(self.stats.snapshot(), {'win': {"calls": 1, "hits": 1,
+                                                         "ns": self.stats.counters['win'][2]}})
+    def test_table_stage_is_recorded_first(self):
+        computer = TTTComputer(PerfectPlayTable.build(), stats=self.stats)
+        computer.play_on_grid(self.grid, "X", "O")
+        self.assertEqual(list(self.stats.snapshot()), ['table'])
+    def test_json_snapshot_and_reset(self):
+        self.computer.play_on_grid(self.grid, "X", "O")
+        self.assertEqual(json.loads(self.stats.to_json()), self.stats.snapshot())
+        self.stats.reset()
+        self.assertEqual(self.stats.snapshot(), {})
+    def test_instrument_and_restore_grid(self):
+        original_play = Grid.play
+        self.stats.instrument_grid()
+        try:
+            with self.assertRaises(RuntimeError):
+                self.stats.instrument_grid()
+            self.grid.play('center')
+            self.grid.play('center')
+            self.grid.get_winning_player()
+        finally:
+            self.stats.restore_grid()
+        self.assertIs(Grid.play, original_play)
+        self.grid.play('top_left')
+        snapshot = self.stats.snapshot()
+        self.assertEqual((snapshot['Grid.play']["calls"], snapshot['Grid.play']["hits"]), (2, 1))
+        self.assertEqual((snapshot['Grid.get_winning_player']["calls"],
+                          snapshot['Grid.get_winning_player']["hits"]), (1, 0))
+
+    def test_cache_lookups_are_recorded_as_a_stage(self):
+        computer = TTTComputer(cache_size=4, stats=self.stats)
+        for _ in range(3):
+            computer.play_on_grid(Grid("XO"), "X", "O")
+        snapshot = self.stats.snapshot()
+        self.assertEqual((snapshot['cache']["calls"], snapshot['cache']["hits"]), (3, 2))
+        self.assertEqual(snapshot['sequential']["calls"], 1)  # Only on the miss
+    def test_grid_instrumented_once_across_instances(self):
+        other = DecisionStats()
+        self.stats.instrument_grid()
+        try:
+            for grid_class in (Grid, type('SubGrid', (Grid,), {})):
+                with self.assertRaises(RuntimeError):
+                    other.instrument_grid(grid_class)
+        finally:
+            self.stats.restore_grid()
+        original_play = Grid.play
+        other.instrument_grid()
+        other.restore_grid()
+        self.assertIs(Grid.play, original_play)
+    def test_restoring_a_subclass_leaves_methods_inherited(self):
+        sub_grid = type('SubGrid', (Grid,), {})
+        self.stats.instrument_grid(sub_grid)
+        self.stats.restore_grid()
+        self.assertNotIn('play', sub_grid.__dict__)
+        self.assertNotIn('get_winning_player', sub_grid.__dict__)
+        self.stats.reset()
+        self.stats.instrument_grid()  # Now Grid's instrumentation reaches SubGrid too
+        try:
+            sub_grid().play('center')
+        finally:
+            self.stats.restore_grid()
+        self.assertEqual(self.stats.snapshot()['Grid.play']["calls"], 1)
+
+class TTT_cached_computer_test(TTT_computer_test):
+    def setUp(self):
+        self.computer = TTTComputer(cache_size=4)
+        self.grid = Grid("XO")
+
+    def test_cache_disabled_by_default(self):
+        computer = TTTComputer()
+        computer.play_on_grid(self.grid, "X", "O")
+        self.assertEqual(computer.cache_info(), {"hits": 0, "misses": 0, "evictions": 0,
+                                                 "size": 0, "max_size": None})
+    def test_invalid_cache_size(self):
+        with self.assertRaises(ValueError):
+            TTTComputer(cache_size=0)
+    def test_repeated_position_is_a_hit(self):
+        for _ in range(3):
+            self.computer.play_on_grid(Grid("XO"), "X", "O")
+        info = self.computer.cache_info()
+        self.assertEqual((info["hits"], info["misses"], info["size"]), (2, 1, 1))
+    def test_marks_are_part_of_key(self):
+        self.computer.play_on_grid(Grid("XO"), "X", "O")
+        self.computer.play_on_grid(Grid("OX"), "O", "X")
+        self.assertEqual(self.computer.cache_info()["misses"], 2)
+    def test_least_recently_used_is_evicted(self):
+        first_moves = Grid.textual_positions[:5]
+        for move in first_moves:
+            grid = Grid("XO")
+            grid.play(move)
+            self.computer.play_on_grid(grid, "O", "X")
+            if move == 'top_middle':  # Refresh first position so the second is LRU
+                grid = Grid("XO")
+                grid.play('top_left')
+                self.computer.play_on_grid(grid, "O", "X")
+        info = self.computer.cache_info()
+        self.assertEqual((info["misses"], info["hits"], info["evictions"], info["size"]),
+                         (5, 1, 1, 4))
+        for move, hits, misses in (('top_left', 2, 5), ('top_middle', 2, 6)):  # Kept, evicted
+            grid = Grid("XO")
+            grid.play(move)
+            self.computer.play_on_grid(grid, "O", "X")
+            info = self.computer.cache_info()
+            self.assertEqual((info["hits"], info["misses"]), (hits, misses), move)
+    def test_cached_move_is_replayed(self):
+        grid_1, grid_2 = Grid("XO"), Grid("XO")
+        for grid in (grid_1, grid_2):
+            grid.play('top_left')
+            self.computer.play_on_grid(grid, "O", "X")
+        self.assertEqual(grid_1.get_grid(), grid_2.get_grid())
+    def test_cache_clear(self):
+        self.computer.play_on_grid(self.grid, "X", "O")
+        self.computer.cache_clear()
+        self.assertEqual(self.computer.cache_info(), {"hits": 0, "misses": 0, "evictions": 0,
+                                                      "size": 0, "max_size": 4})
+
+class TTT_line_count_test(unittest.TestCase):
+    '''The line-count heuristics against the set algebra they replaced.'''
+    def setUp(self):
+        self.computer = TTTComputer()
+        self.with_sets = SetAlgebraComputer()
+    def test_lines_are_the_winning_lines(self):
+        winning_lines = {frozenset(Grid.textual_positions.index(posn) for posn in line)
+                         for line in Grid.winning_lines}
+        self.assertEqual({frozenset(line) for line in TTTComputer.lines}, winning_lines)
+        self.assertEqual(len(TTTComputer.lines), len(winning_lines))
+        for cell, lines in enumerate(TTTComputer.cell_lines):
+            self.assertEqual(lines, tuple(idx for idx, line in enumerate(TTTComputer.lines)
+                                          if cell in line), cell)
+    def test_triples_are_as_before(self):
+        triples = [{0, 4, 8}, {2, 4, 6}]  # Diagonals
+        for i in range(0, 3):
+            triples.append({0+(3*i), 1+(3*i), 2+(3*i)})  # Horizontals
+            triples.append({0+i, 3+i, 6+i})  # Verticals
+        self.assertEqual(self.computer.triples, triples)
+    def test_same_answers_as_sets_in_every_position(self):
+        computer, with_sets = self.computer, self.with_sets
+        for markers in ("XO", "*+"):
+            for grid in PositionVerifier.iter_positions(markers):
+                grid_s = grid.get_grid()
+                for mark, other_mark in (markers, markers[::-1]):
+                    self.assertEqual(computer._try_to_win(grid_s, mark),
+                                     with_sets._try_to_win(grid_s, mark), grid_s)
+                    self.assertEqual(computer._try_to_avoid_loss(grid_s, mark),
+                                     with_sets._try_to_avoid_loss(grid_s, mark), grid_s)
+                    forks = computer._detect_fork_move_for_mark(grid_s, mark, other_mark)
+                    forks_with_sets = with_sets._detect_fork_move_for_mark(grid_s, mark, other_mark)
+                    self.assertEqual(sorted(forks), sorted(forks_with_sets), grid_s)
+                    self.assertEqual(forks[:1], forks_with_sets[:1], grid_s)  # The move played
+    def test_first_fork_is_first_of_a_set(self):
+        for fork_bits in range(1, 512):
+            forks = {idx for idx in range(9) if fork_bits >> idx & 1}  # 0 added before 8
+            self.assertEqual(TTTComputer.first_fork[fork_bits], list(forks)[0], forks)
+        self.assertEqual(TTTComputer.first_fork[0], -1)
+    def test_counts_follow_the_position(self):
+        computer = self.computer
+        self.assertEqual(computer._try_to_win("XX OO    ", "X"), 2)
+        self.assertEqual(computer._try_to_win("XXOOO    ", "X"), None)
+        self.assertEqual(computer._try_to_win("XXOOO    ", "O"), 6)  # Diagonal first
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class BatchComputerTest(unittest.TestCase):
+    markers = "XO"
+    @classmethod
+    def setUpClass(cls):
+        cls.grids = list(PositionVerifier.iter_positions(cls.markers))
+    def setUp(self):
+        self.computer = BatchComputer()
+    def _play_on_grid_moves(self, with_mark: str, vs_mark: str) -> List[int]:
+        computer = TTTComputer()
+        moves = []
+        for grid in self.grids:
+            before = grid.get_grid()
+            computer.play_on_grid(grid, with_mark, vs_mark)
+            after = grid.get_grid()
+            moves.append(next((idx for idx in range(9) if before[idx] != after[idx]), -1))
+            if after != before:
+                grid.undo()
+        return moves
+    def test_encode(self):
+        cells = BatchComputer.encode([" "*9, self.markers + " "*6 + self.markers[0]], self.markers)
+        self.assertEqual(cells.tolist(), [[0]*9, [1, 2, 0, 0, 0, 0, 0, 0, 1]])
+        self.assertEqual(BatchComputer.encode([], self.markers).shape, (0, 9))
+    def test_matches_play_on_grid_for_both_marks_in_every_position(self):
+        cells = BatchComputer.encode((grid.get_grid() for grid in self.grids), self.markers)
+        for code, (with_mark, vs_mark) in ((1, self.markers), (2, self.markers[::-1])):
+            self.assertEqual(self.computer.moves(cells, code).tolist(),
+                             self._play_on_grid_moves(with_mark, vs_mark), with_mark)
+    def test_mark_to_play_defaults_to_whose_turn_it_is(self):
+        cells = BatchComputer.encode((grid.get_grid() for grid in self.grids), self.markers)
+        with_codes = [1 if grid.get_grid().count(" ") % 2 else 2 for grid in self.grids]
+        self.assertEqual(self.computer.moves(cells).tolist(),
+                         self.computer.moves(cells, with_codes).tolist())
+    def test_full_board_has_no_move(self):
+        self.assertEqual(self.computer.moves([[1, 2, 1, 1, 2, 2, 2, 1, 1]]).tolist(), [-1])
+    def test_play_on_batch_follows_play_on_grid(self):
+        openings = list(range(9))
+        batch = BatchGrid(len(openings), self.markers)
+        batch.play(openings)
+        grids = [Grid(self.markers) for move in openings]
+        for grid, move in zip(grids, openings):
+            grid.play(Grid.textual_positions[move])
+        computer = TTTComputer()
+        for turn in range(8):
+            self.computer.play_on_batch(batch)
+            for idx, grid in enumerate(grids):
+                with_mark, vs_mark = self.markers if turn % 2 else self.markers[::-1]
+                computer.play_on_grid(grid, with_mark, vs_mark)
+                self.assertEqual(batch.get_grid(idx), grid.get_grid(), idx)
+        self.assertTrue(batch.is_full().all())
+        self.assertEqual([batch.get_winning_player(idx) for idx in range(len(grids))],
+                         [grid.get_winning_player() for grid in grids])
+
+class BatchComputerTest_OX(BatchComputerTest):
+    markers = "OX"
+
+class NeverLosesTestMixin:
+    '''For test cases whose self.computer should never lose on a 3x3 Grid.'''
+    def _assert_never_loses(self, grid: Grid, with_mark: str, vs_mark: str, computer_to_play: bool):
+        '''Explores every opponent reply from grid, checking the computer never loses.'''
+        if grid.get_winning_player() is not None or grid.is_full():
+            self.assertNotEqual(grid.get_winning_player(), vs_mark, grid.get_grid())
+            return
+        for move in [None] if computer_to_play else Grid.textual_positions:
+            next_grid = Grid(grid.markers)
+            for posn in grid.played_positions:  # Replayed in the original order
+                next_grid.play(posn)
+            if computer_to_play:
+                self.computer.play_on_grid(next_grid, with_mark, vs_mark)
+            elif next_grid.play(move) is None:
+                continue
+            self._assert_never_loses(next_grid, with_mark, vs_mark, not computer_to_play)
+
+class TTT_table_computer_test(NeverLosesTestMixin, TTT_computer_test):
+    @classmethod
+    def setUpClass(cls):
+        cls.table = PerfectPlayTable.build()
+    def setUp(self):
+        self.computer = TTTComputer(self.table)
+        self.grid = Grid("XO")
+
+    def test_computer_never_loses_playing_first(self):
+        self._assert_never_loses(Grid("XO"), "X", "O", True)
+    def test_computer_never_loses_playing_second(self):
+        self._assert_never_loses(Grid("XO"), "O", "X", False)
+    def test_computer_still_plays_after_game_is_won(self):
+        for move in ['top_left', 'top_right', 'middle_left', 'middle_right', 'bottom_left']:
+            self.grid.play(move)
+        self.computer.play_on_grid(self.grid, "O", "X")
+        self.assertNumberOfPlaysOnGrid(self.grid.get_grid(), 6)
+
+class PerfectPlayTableTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.table = PerfectPlayTable.build()
+    def test_canonical_position_count(self):
+        self.assertEqual(len(self.table.canonical_moves), PerfectPlayTable.canonical_positions)
+    def test_load_rejects_malformed_entries(self):
+        position, rotated = "        T", "      T  "  # Rotated isn't canonical
+        mask = self.table.canonical_moves[position]
+        for bad_position, bad_mask in ((position, 0), (position, 1 << 9), (position, "1"),
+                                       (position, 1.0), (position, True), (rotated, mask),
+                                       (position[:8], mask), (position[:8] + "X", mask)):
+            positions = dict(self.table.canonical_moves)
+            del positions[position]
+            positions[bad_position] = bad_mask
+            with tempfile.TemporaryDirectory() as cache_dir:
+                path = os.path.join(cache_dir, "table.json")
+                with open(path, "w") as cache_file:
+                    json.dump({"version": 1, "positions": positions}, cache_file)
+                with self.assertRaises(ValueError, msg=(bad_position, bad_mask)):
+                    PerfectPlayTable.load(path)
+    def test_table_is_symmetry_reduced(self):
+        self.assertLess(len(self.table.canonical_moves) * 4, len(self.table))
+    def test_canonical_position_is_same_for_all_orientations(self):
+        position = "M  T     "
+        for perm in PerfectPlayTable.symmetries:
+            oriented = "".join(position[src] for src in perm)
+            self.assertEqual(PerfectPlayTable.canonical(oriented), PerfectPlayTable.canonical(position))
+    def test_move_is_independent_of_marker_names(self):
+        self.assertEqual(self.table.get_move("X   O   X", "O", "X"),
+                         self.table.get_move("*   +   *", "+", "*"))
+    def test_no_move_when_not_reachable_with_mark_to_play(self):
+        self.assertIsNone(self.table.get_move("X        ", "X", "O"))  # Not X's turn
+        self.assertIsNone(self.table.get_move("XXX OO   ", "O", "X"))
+    def test_load_or_build_uses_disk_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, "table.json")
+            built = PerfectPlayTable.load_or_build(path)
+            self.assertTrue(os.path.exists(path))
+            loaded = PerfectPlayTable.load_or_build(path)
+            self.assertEqual(loaded.canonical_moves, built.canonical_moves)
+            self.assertEqual(loaded._moves, built._moves)
+    def test_load_or_build_replaces_unreadable_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, "table.json")
+            for contents in ('{"version": 1, "posi', '[]', '{"version": 1}', '{"version": 0}',
+                             '{"version": 1, "positions": []}',
+                             '{"version": 1, "positions": {}}',
+                             '{"version": 1, "positions": {"abc": 1}}',
+                             '{"version": 1, "positions": {"         ": "x"}}'):
+                with open(path, "w") as cache_file:
+                    cache_file.write(contents)
+                table = PerfectPlayTable.load_or_build(path)
+                self.assertEqual(table.canonical_moves, self.table.canonical_moves, contents)
+                self.assertEqual(PerfectPlayTable.load(path).canonical_moves, self.table.canonical_moves)
+    def test_save_is_atomic(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, "table.json")
+            self.table.save(path)
+            with open(path) as cache_file:
+                saved = cache_file.read()
+            failing_table = PerfectPlayTable(self.table.canonical_moves)
+            failing_table.canonical_moves = {"unserializable": object()}
+            with self.assertRaises(TypeError):
+                failing_table.save(path)
+            with open(path) as cache_file:
+                self.assertEqual(cache_file.read(), saved)  # Untouched by the failed save
+            self.assertEqual(os.listdir(cache_dir), ["table.json"])
+    def test_load_rejects_other_version(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, "table.json")
+            with open(path, "w") as cache_file:
+                json.dump({"version": 0, "positions": {}}, cache_file)
+            with self.assertRaises(ValueError):
+                PerfectPlayTable.load(path)
+
+class SearchComputerTest(NeverLosesTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.computer = SearchComputer()
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            SearchComputer('cheese')
+    def test_alphabeta_never_loses_playing_first(self):
+        self._assert_never_loses(Grid("XO"), "X", "O", True)
+    def test_alphabeta_never_loses_playing_second(self):
+        self._assert_never_loses(Grid("XO"), "O", "X", False)
+    def test_alphabeta_searches_without_table(self):
+        grid = Grid("XO")
+        grid.play_index(4)
+        self.computer.play_on_grid(grid, "O", "X")
+        self.assertGreater(self.computer.last_search["nodes"], 0)
+    def test_never_loses_with_table_in_either_mode(self):
+        for mode in SearchComputer.modes:
+            self.computer = SearchComputer(mode, time_budget=0.001, seed=0,
+                                           table=PerfectPlayTable.shared())
+            self._assert_never_loses(Grid("XO"), "X", "O", True)
+            self._assert_never_loses(Grid("XO"), "O", "X", False)
+    def test_mcts_wins_or_blocks_in_every_position(self):
+        computer = SearchComputer('mcts', time_budget=0.001, seed=0)
+        for grid in PositionVerifier.iter_positions(finished=False):
+            grid_s = grid.get_grid()
+            with_mark, vs_mark = "XO" if grid_s.count(" ") % 2 else "OX"
+            mine, theirs = (sum(1 << idx for idx, entry in enumerate(grid_s) if entry == mark)
+                            for mark in (with_mark, vs_mark))
+            empty = [idx for idx, entry in enumerate(grid_s) if entry == " "]
+            wins = [idx for idx in empty if PerfectPlayTable._is_win(mine | 1 << idx)]
+            blocks = [idx for idx in empty if PerfectPlayTable._is_win(theirs | 1 << idx)]
+            if not wins and not blocks:
+                continue
+            computer.play_on_grid(grid, with_mark, vs_mark)
+            move = next(idx for idx in range(9) if grid_s[idx] != grid.get_grid()[idx])
+            self.assertIn(move, wins or blocks, grid_s)
+    def test_small_boards_keep_to_time_budget(self):
+        for mode in SearchComputer.modes:
+            for grid in (Grid("XO"), MNKGrid(1, 9, 3)):
+                computer = SearchComputer(mode, time_budget=0.01, seed=0)
+                start_time = time.perf_counter()
+                computer.play_on_grid(grid, "X", "O")
+                self.assertLess(time.perf_counter() - start_time, 0.05, (mode, grid.columns))
+    def test_mcts_blocks_on_large_board(self):
+        grid = MNKGrid(15, 15, 5)
+        for column, x_move in enumerate(((7, 4), (0, 0), (0, 2), (0, 4))):
+            grid.play_index(grid.index(*x_move))  # First blocks one end of O's four
+            grid.play_index(grid.index(7, 5 + column))
+        SearchComputer('mcts', time_budget=0.05, seed=0).play_on_grid(grid, "X", "O")
+        self.assertEqual(grid.get_grid()[grid.index(7, 9)], "X")
+    def _play_after(self, mode: str, moves: Tuple[int, ...]) -> str:
+        grid = Grid("XO")
+        for idx in moves:
+            grid.play_index(idx)
+        SearchComputer(mode, time_budget=0.1, seed=0).play_on_grid(grid, "X", "O")
+        return grid.get_grid()
+    def test_takes_win_in_both_modes(self):
+        for mode in SearchComputer.modes:
+            self.assertEqual(self._play_after(mode, (0, 3, 1, 4)), "XXXOO    ", mode)
+    def test_blocks_in_both_modes(self):
+        for mode in SearchComputer.modes:
+            self.assertEqual(self._play_after(mode, (0, 4, 1)), "XXO O    ", mode)
+    def test_no_move_once_game_over(self):
+        grid = Grid("XO")
+        for idx in (0, 3, 1, 4, 2):
+            grid.play_index(idx)
+        self.computer.play_on_grid(grid, "O", "X")
+        self.assertEqual(grid.get_grid(), "XXXOO    ")
+    def test_responsive_on_large_board(self):
+        for mode in SearchComputer.modes:
+            computer = SearchComputer(mode, time_budget=0.05, seed=0)
+            grid = MNKGrid(15, 15, 5)
+            for move in range(4):
+                start_time = time.perf_counter()
+                computer.play_on_grid(grid, "X", "O")
+                self.assertLess(time.perf_counter() - start_time, 0.5, mode)
+            self.assertEqual(len(grid.get_grid().replace(" ", "")), 4, mode)
+            self.assertGreater(computer.last_search["nodes_per_second"], 0, mode)
+    def test_completes_open_four_on_large_board(self):
+        for mode in SearchComputer.modes:
+            grid = MNKGrid(15, 15, 5)
+            for column in range(4):
+                grid.play_index(grid.index(7, 5 + column))
+                grid.play_index(grid.index(0, 2*column))
+            SearchComputer(mode, time_budget=0.1, seed=0).play_on_grid(grid, "X", "O")
+            self.assertEqual(grid.get_winning_player(), "X", mode)
+
+class TournamentTest(unittest.TestCase):
+    def setUp(self):
+        self.tournament = Tournament(processes=2, chunk_size=25)
+    def test_play_game_between_computers_is_a_draw(self):
+        self.assertIsNone(Tournament.play_game(TTTComputer(), TTTComputer()))
+    def test_play_game_fills_grid_or_has_winner(self):
+        for seed in range(20):
+            winner = Tournament.play_game(RandomPlayer(seed), RandomPlayer(seed + 1), "*+")
+            self.assertIn(winner, ("*", "+", None))
+    def test_random_player_plays_once_in_empty_position(self):
+        grid = Grid()
+        grid.play('center')
+        RandomPlayer(0).play_on_grid(grid, "O", "X")
+        self.assertEqual(len(grid.get_grid().replace(" ", "")), 2)
+        self.assertEqual(grid.get_grid()[4], "X")
+    def test_computer_vs_computer_counts(self):
+        result = self.tournament.play('computer', 'computer', 60)
+        self.assertEqual((result.first_wins, result.draws, result.second_wins), (0, 60, 0))
+        self.assertGreater(result.games_per_second, 0)
+    def test_computer_never_loses_to_random_playing_first(self):
+        as_first = self.tournament.play('computer', 'random', 100, seed=1)
+        as_second = self.tournament.play('random', 'computer', 100, seed=2)
+        self.assertEqual(as_first.second_wins, 0)  # Second, it can lose (see PositionVerifier)
+        self.assertEqual((as_first.games, as_second.games), (100, 100))
+    def test_table_never_loses_to_random_either_side(self):
+        as_first = self.tournament.play('table', 'random', 100, seed=1)
+        as_second = self.tournament.play('random', 'table', 100, seed=10)
+        self.assertEqual(as_first.second_wins, 0)
+        self.assertEqual(as_second.first_wins, 0)
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            self.tournament.play('cheese', 'random', 10)
+    def test_scaling_reports_each_worker_count(self):
+        report = self.tournament.scaling('random', 'random', 50, [1, 2])
+        self.assertEqual([workers for workers, rate, efficiency in report], [1, 2])
+        self.assertEqual(report[0][2], 1.0)
+
+class PositionVerifierTest(unittest.TestCase):
+    def setUp(self):
+        self.verifier = PositionVerifier(processes=2, chunk_size=100)
+    def test_number_of_reachable_positions(self):
+        self.assertEqual(sum(1 for grid in PositionVerifier.iter_positions()), 5478)
+        self.assertEqual(sum(1 for grid in PositionVerifier.iter_positions(unique=True)), 765)
+        self.assertEqual(sum(1 for grid in PositionVerifier.iter_positions(finished=False)), 4520)
+    def test_positions_are_lazy_fresh_grids(self):
+        positions = PositionVerifier.iter_positions("*+")
+        first, second = next(positions), next(positions)
+        self.assertTrue(first.is_empty())
+        self.assertEqual(second.get_grid(), "*" + " "*8)
+        second.undo()
+        self.assertEqual(next(positions).get_grid(), "*+" + " "*7)
+    def test_perfect_play_table_has_no_counterexamples(self):
+        result = self.verifier.verify('table', unique=False)
+        self.assertEqual(result.checked, 4520)
+        self.assertEqual(result.counterexamples, [])
+        self.assertGreater(result.positions_per_second, 0)
+    def test_counterexamples_are_forced_losses(self):
+        result = self.verifier.verify('computer', "OX")
+        self.assertEqual(result.checked, 4520)
+        self.assertIn(("O   X   O", "X", 2), result.counterexamples)
+        for grid_s, with_mark, move in result.counterexamples:
+            vs_mark = "X" if with_mark == "O" else "O"
+            self.assertEqual(grid_s[move], " ")
+            self.assertGreaterEqual(PerfectPlayTable.outcome(grid_s, with_mark, vs_mark), 0)
+            self.assertEqual(PerfectPlayTable.move_outcome(grid_s, with_mark, vs_mark, move), -1)
+    def test_unique_sweep_finds_the_same_counterexample_classes(self):
+        full = self.verifier.verify('computer')
+        reduced = self.verifier.verify('computer', unique=True)
+        self.assertEqual(reduced.checked, full.checked)
+        classes = [{PerfectPlayTable.canonical(grid_s) for grid_s, with_mark, move in result.counterexamples}
+                   for result in (full, reduced)]
+        self.assertEqual(classes[0], classes[1])
+        self.assertIn(PerfectPlayTable.canonical('  OX    X'), classes[1])
+        self.assertIn(PerfectPlayTable.canonical('  XX O OX'), classes[1])
+        self.assertEqual(len(classes[1]), 8)
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            self.verifier.verify('cheese')
+
+class GameServerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = GameServer(idle_timeout=60)
+        self.owned = set()  # type: Set[int]
+    def _request(self, request) -> dict:
+        return self.server.handle_request(request, self.owned)
+    def test_new_session_is_empty_grid(self):
+        state = self._request({"op": "new"})
+        self.assertEqual((state["ok"], state["grid"], state["mark"], state["winner"], state["full"]),
+                         (True, " "*9, "X", None, False))
+    def test_play_gets_computer_reply(self):
+        session = self._request({"op": "new"})["session"]
+        state = self._request({"op": "play", "session": session, "position": "top_left"})
+        self.assertEqual(state["grid"], "X   O    ")
+    def test_computer_can_move_first_with_custom_markers(self):
+        state = self._request({"op": "new", "markers": "*+", "computer_first": True})
+        self.assertEqual((state["grid"], state["mark"]), ("*        ", "+"))
+    def test_invalid_requests(self):
+        session = self._request({"op": "new"})["session"]
+        for request, error in (({"op": "new", "markers": "OO"}, "invalid markers"),
+                               ({"op": "cheese"}, "unknown op"),
+                               ({"op": "play", "session": 999, "position": "center"}, "unknown session"),
+                               ({"op": "end", "session": [session]}, "unknown session"),
+                               ({"op": "play", "session": session, "position": "cheese"}, "invalid move"),
+                               ([], "request must be an object")):
+            state = self._request(request)
+            self.assertEqual((state["ok"], state["error"]), (False, error))
+    def test_markers_must_be_two_distinct_non_blank_characters(self):
+        for markers in ({"X": 1, "O": 2}, [1, 2], ["X", "O"], " X", "X ", "XOX", 12, None):
+            state = self._request({"op": "new", "markers": markers})
+            self.assertEqual((state["ok"], state["error"]), (False, "invalid markers"), markers)
+        self.assertEqual(self.server.sessions, {})
+    def test_computer_first_must_be_boolean(self):
+        for computer_first in ("no", 1, 0, None, []):
+            state = self._request({"op": "new", "computer_first": computer_first})
+            self.assertEqual((state["ok"], state["error"]), (False, "invalid computer_first"))
+        self.assertEqual(self.server.sessions, {})
+    def test_boolean_is_not_a_session(self):
+        session = self._request({"op": "new"})["session"]
+        self.assertEqual(session, 1)
+        for op in ("play", "end"):
+            state = self._request({"op": op, "session": True, "position": "center"})
+            self.assertEqual((state["ok"], state["error"]), (False, "unknown session"))
+        self.assertEqual(self.server.sessions[session].grid.get_grid(), " "*9)
+    def test_unexpected_error_is_reported_and_connection_kept(self):
+        handle_request = self.server.handle_request
+        def failing_handle_request(request, owned):
+            if request.get("op") == "fail":
+                raise KeyError("fail")
+            return handle_request(request, owned)
+        self.server.handle_request = failing_handle_request
+        async def converse():
+            port = await self.server.start()
+            try:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                responses = []
+                for request in ({"op": "fail", "id": 1}, {"op": "new", "id": 2}):
+                    writer.write(json.dumps(request).encode() + b"\n")
+                    responses.append(json.loads(await reader.readline()))
+                writer.close()
+                return responses
+            finally:
+                await self.server.close()
+        with self.assertLogs(level="ERROR") as logs:
+            failed, created = asyncio.run(converse())
+        self.assertIn("KeyError", logs.output[0])
+        self.assertEqual(failed, {"ok": False, "error": "internal error", "id": 1})
+        self.assertEqual((created["ok"], created["id"]), (True, 2))
+    def test_reports_outcome_and_refuses_play_after_game_over(self):
+        session = self._request({"op": "new"})["session"]
+        for position in ('top_middle', 'bottom_middle', 'middle_left', 'bottom_right'):
+            state = self._request({"op": "play", "session": session, "position": position})
+            if state["winner"] is not None:
+                break
+        self.assertEqual(state["winner"], "O")
+        state = self._request({"op": "play", "session": session, "position": "top_right"})
+        self.assertEqual((state["ok"], state["error"]), (False, "game over"))
+    def test_max_sessions(self):
+        server = GameServer(max_sessions=1)
+        self.assertTrue(server.handle_request({"op": "new"}, set())["ok"])
+        self.assertEqual(server.handle_request({"op": "new"}, set())["error"], "server busy")
+    def test_end_and_idle_sessions_are_removed(self):
+        ended = self._request({"op": "new"})["session"]
+        idle = self._request({"op": "new"})["session"]
+        active = self._request({"op": "new"})["session"]
+        self.assertTrue(self._request({"op": "end", "session": ended})["ok"])
+        self.server.sessions[idle].last_active -= 61
+        self.assertEqual(self.server.evict_idle(), 1)
+        self.assertEqual(list(self.server.sessions), [active])
+    def test_sessions_belong_to_their_connection(self):
+        session = self._request({"op": "new"})["session"]
+        for op in ("play", "end"):
+            state = self.server.handle_request({"op": op, "session": session, "position": "center"}, set())
+            self.assertEqual((state["ok"], state["error"]), (False, "unknown session"))
+        self.assertEqual(self.server.sessions[session].grid.get_grid(), " "*9)
+    def test_evicted_session_is_unknown(self):
+        session = self._request({"op": "new"})["session"]
+        self.server.sessions[session].last_active -= 61
+        self.server.evict_idle()
+        state = self._request({"op": "play", "session": session, "position": "center"})
+        self.assertEqual((state["ok"], state["error"]), (False, "unknown session"))
+        self.assertEqual(self.owned, set())
+    async def _send(self, writer: asyncio.StreamWriter, reader: asyncio.StreamReader, request: dict) -> dict:
+        writer.write(json.dumps(request).encode() + b"\n")
+        return json.loads(await reader.readline())
+    def test_disconnect_removes_sessions(self):
+        async def converse():
+            port = await self.server.start()
+            try:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                for _ in range(3):
+                    await self._send(writer, reader, {"op": "new"})
+                other_reader, other_writer = await asyncio.open_connection("127.0.0.1", port)
+                kept = (await self._send(other_writer, other_reader, {"op": "new"}))["session"]
+                created = len(self.server.sessions)
+                writer.close()
+                await writer.wait_closed()
+                while len(self.server.sessions) > 1:  # Until the server sees the close
+                    await asyncio.sleep(0.01)
+                other_writer.close()
+                return created, list(self.server.sessions), kept
+            finally:
+                await self.server.close()
+        created, remaining, kept = asyncio.run(asyncio.wait_for(converse(), 5))
+        self.assertEqual((created, remaining), (4, [kept]))
+    def test_close_disconnects_clients(self):
+        async def connect_then_close():
+            port = await self.server.start()
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            await self._send(writer, reader, {"op": "new"})
+            await asyncio.wait_for(self.server.close(), 5)  # Client still connected
+            return await reader.read()
+        self.assertEqual(asyncio.run(connect_then_close()), b"")
+    def test_load_generator_over_localhost(self):
+        async def serve_and_load():
+            port = await self.server.start()
+            try:
+                return await GameLoadGenerator("127.0.0.1", port, sessions=200, connections=4).run()
+            finally:
+                await self.server.close()
+        report = asyncio.run(serve_and_load())
+        self.assertEqual((report["sessions"], report["errors"]), (200, 0))
+        self.assertGreaterEqual(report["moves"], 200 * 3)
+        self.assertLessEqual(report["p50_ms"], report["p99_ms"])
+        self.assertEqual(self.server.sessions, {})
+
+class GameRecordTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "games.ttt")
+        self.games = [("XO", (0, 3, 1, 4, 2)),  # First wins
+                      ("OX", (0, 3, 1, 4, 8, 5)),  # Second wins
+                      ("*+", (4, 0, 8, 2, 1, 7, 3, 5, 6)),  # Draw
+                      ("XO", (4, 0)),  # Unfinished
+                      ("XO", ())]
+    def tearDown(self):
+        self.directory.cleanup()
+    def test_record_is_seven_bytes(self):
+        self.assertEqual(GameRecordWriter.encode("XO", (0, 1, 2, 3, 4, 5, 6, 7, 8)),
+                         b"XO\x01\x23\x45\x67\x8f")
+        self.assertEqual(GameRecordWriter.encode("XO", ()), b"XO" + b"\xff"*5)
+    def test_invalid_records(self):
+        for markers, moves in (("OO", ()), ("X", ()), ("X\u263a", ())):
+            with self.assertRaises(InvalidMarkers):
+                GameRecordWriter.encode(markers, moves)
+        for moves in ((9,), (-1,), (1, 1), tuple(range(9)) + (0,)):
+            with self.assertRaises(ValueError):
+                GameRecordWriter.encode("XO", moves)
+    def test_round_trip_with_appends(self):
+        with GameRecordWriter(self.path) as writer:
+            self.assertEqual(writer.write_many(self.games[:3]), 3)
+        with GameRecordWriter(self.path) as writer:
+            for markers, moves in self.games[3:]:
+                writer.write(markers, moves)
+        with GameRecordReader(self.path) as reader:
+            self.assertEqual(len(reader), len(self.games))
+            self.assertEqual(list(reader), self.games)
+    def test_replay_into_grids_and_outcomes(self):
+        with GameRecordWriter(self.path) as writer:
+            writer.write_many(self.games)
+        with GameRecordReader(self.path) as reader:
+            grids = list(reader.grids())
+            self.assertEqual([GameRecordWriter.moves_of(grid) for grid in grids],
+                             [list(moves) for markers, moves in self.games])
+            self.assertEqual([grid.get_winning_player() for grid in grids], ["X", "X", None, None, None])
+            self.assertEqual([reader.outcome(moves) for markers, moves in reader],
+                             ['first', 'second', 'draw', 'unfinished', 'unfinished'])
+    def test_filter_by_outcome(self):
+        with GameRecordWriter(self.path) as writer:
+            writer.write_many(self.games)
+        with GameRecordReader(self.path) as reader:
+            self.assertEqual(list(reader.filter('second', 'draw')), self.games[1:3])
+            with self.assertRaises(ValueError):
+                list(reader.filter('cheese'))
+    def test_corrupt_records(self):
+        for record in (b"XO\x01\x23\x45\x67\x80",  # No padding
+                       b"XO\x9f\xff\xff\xff\xff",  # Move out of range
+                       b"XO\xef\xff\xff\xff\xff",
+                       b"XO\x0f\x1f\xff\xff\xff",  # Move after padding
+                       b"XO\x00\xff\xff\xff\xff",  # Repeated move
+                       b"XX\xff\xff\xff\xff\xff"):
+            with open(self.path, "wb") as archive:
+                archive.write(GameRecordWriter.magic + GameRecordWriter.encode("XO", (4,)) + record)
+            with GameRecordReader(self.path) as reader:
+                records = iter(reader)
+                self.assertEqual(next(records), ("XO", (4,)))
+                with self.assertRaisesRegex(ValueError, "Corrupt game record at offset 11"):
+                    next(records)
+    def test_rejects_other_files(self):
+        with open(self.path, "wb") as other:
+            other.write(b"cheese")
+        with self.assertRaises(ValueError):
+            GameRecordReader(self.path)
+        with open(self.path, "wb") as truncated:
+            truncated.write(GameRecordWriter.magic + b"XO")
+        with self.assertRaises(ValueError):
+            GameRecordReader(self.path)
+
+class BenchCompareTest(unittest.TestCase):
+    '''The regression gate of bench.py.'''
+    def setUp(self):
+        import bench
+        self.baseline = {"fast": {"median_ns": 100.0}, "zero": {"median_ns": 0.0}}
+        self.compare = bench.compare
+        self.compare_sizes = bench.compare_sizes
+    def _regressions(self, results, threshold=0.10, name_filter=None):
+        '''Compares against the baseline entries for results unless name_filter
+           is given, when the whole baseline is used.'''
+        baseline = self.baseline
+        if name_filter is None:
+            baseline = {name: baseline[name] for name in results if name in baseline}
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            regressions = self.compare(results, baseline, threshold, name_filter or "")
+        return regressions, output.getvalue()
+    def test_within_threshold_passes(self):
+        regressions, output = self._regressions({"fast": {"median_ns": 109.0}})
+        self.assertEqual(regressions, [])
+        self.assertNotIn("REGRESSION", output)
+    def test_slower_than_threshold_fails(self):
+        regressions, output = self._regressions({"fast": {"median_ns": 111.0}})
+        self.assertEqual(regressions, ["fast"])
+        self.assertIn("REGRESSION", output)
+        self.assertEqual(self._regressions({"fast": {"median_ns": 111.0}}, 0.2)[0], [])
+    def test_missing_from_baseline_is_reported_not_failed(self):
+        regressions, output = self._regressions({"new_benchmark_with_a_long_name": {"median_ns": 5.0}})
+        self.assertEqual(regressions, [])
+        self.assertIn("new_benchmark_with_a_long_name", output)
+        self.assertIn("not in baseline", output)
+    def test_missing_from_results_fails(self):
+        regressions, output = self._regressions({"fast": {"median_ns": 100.0}}, name_filter="")
+        self.assertEqual(regressions, ["zero"])
+        self.assertIn("zero", output)
+        self.assertIn("MISSING", output)
+    def test_missing_from_results_passes_when_filtered_out(self):
+        regressions, output = self._regressions({"fast": {"median_ns": 100.0}}, name_filter="fast")
+        self.assertEqual(regressions, [])
+        self.assertNotIn("zero", output)
+    def test_larger_objects_fail(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(self.compare_sizes({"grid": 330.0, "bitgrid": 72.0, "new": 1.0},
+                                                 {"grid": 160.0, "bitgrid": 72.0}, 0.10), ["grid"])
+    def test_zero_baseline(self):
+        self.assertEqual(self._regressions({"zero": {"median_ns": 1.0}})[0], ["zero"])
+    def test_names_are_aligned(self):
+        output = self._regressions({"fast": {"median_ns": 100.0},
+                                    "new_benchmark_with_a_long_name": {"median_ns": 5.0}})[1]
+        self.assertEqual(len({line.index(" ns") for line in output.splitlines()}), 1)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,1017 @@
+from typing import Optional, List, Dict, Set, Tuple, Iterable
+from collections import OrderedDict
+
+import json
+import math
+import os
+import random
+import tempfile
+import time
+
+try:
+    import numpy as np
+except ImportError:  # Only needed for BatchGrid and BatchComputer
+    np = None
+
+class InvalidMarkers(Exception):
+    pass
+
+class Grid:
+    textual_positions = ['top_left', 'top_middle', 'top_right',
+                         'middle_left', 'center', 'middle_right',
+                         'bottom_left', 'bottom_middle', 'bottom_right']
+    rows = columns = k = 3  # As an MNKGrid
+    winning_lines = [('top_left', 'middle_left', 'bottom_left'),  # Down
+                     ('top_middle', 'center', 'bottom_middle'),
+                     ('top_right', 'middle_right', 'bottom_right'),
+                     ('top_left', 'top_middle', 'top_right'),  # Across
+                     ('middle_left', 'center', 'middle_right'),
+                     ('bottom_left', 'bottom_middle', 'bottom_right'),
+                     ('top_left', 'center', 'bottom_right'),  # Diagonal
+                     ('top_right', 'center', 'bottom_left'),
+    ]
+    lines_through_position = {  # Indices into winning_lines
+        'top_left': (0, 3, 6), 'top_middle': (1, 3), 'top_right': (2, 3, 7),
+        'middle_left': (0, 4), 'center': (1, 4, 6, 7), 'middle_right': (2, 4),
+        'bottom_left': (0, 5, 7), 'bottom_middle': (1, 5), 'bottom_right': (2, 5, 6),
+    }
+    _line_slots = {position: (lines, tuple(8 + line for line in lines))  # By marker index
+                   for position, lines in lines_through_position.items()}
+    __slots__ = ('played_positions', 'markers', '_line_counts', '_completed', '_redo', '_redo_limit')
+    def __init__(self, markers: str = "XO") -> None:
+        if len(markers) != 2:
+            raise InvalidMarkers()
+        if markers[0] == markers[1]:
+            raise InvalidMarkers()
+        self.played_positions = {}  # In play order, so also the move history
+        self.markers = markers
+        # Plays on each winning line, at 8*marker index + line; completed lines
+        # are counted in 4 bits per marker, the first marker's lowest
+        self._line_counts = [0]*16
+        self._completed = 0
+        # Undone positions by play number, allocated on the first undo; those from
+        # len(played_positions) up to _redo_limit can be redone
+        self._redo = None  # type: Optional[List[Optional[str]]]
+        self._redo_limit = 0
+    def is_empty(self) -> bool:
+        return len(self.played_positions) == 0
+    def is_full(self) -> bool:
+        return len(self.played_positions) == 9
+    def get_grid(self) -> str:
+        if self.is_empty():
+            return " "*9
+        return "".join(self.played_positions[posn]
+                           if posn in self.played_positions else " "
+                       for posn in self.textual_positions)
+    def __str__(self) -> str:
+        return self.get_grid()
+    def play(self, position: str) -> Optional[str]:
+        if position in self.played_positions:
+            return None
+        if position not in self.lines_through_position:
+            return None
+        self._redo_limit = 0  # A new move discards any undone ones
+        return self._apply(position)
+    def play_index(self, idx: int) -> Optional[str]:
+        if not 0 <= idx < 9:
+            return None
+        return self.play(self.textual_positions[idx])
+    def _apply(self, position: str) -> str:
+        marker_idx = len(self.played_positions) % 2
+        marker = self.markers[marker_idx]
+        self.played_positions[position] = marker
+        line_counts = self._line_counts
+        for slot in self._line_slots[position][marker_idx]:
+            count = line_counts[slot] + 1
+            line_counts[slot] = count
+            if count == 3:
+                self._completed += 1 << 4*marker_idx
+        return marker
+    def undo(self) -> Optional[str]:
+        '''Takes back the last move; returns its position, or None if there is none.'''
+        played_positions = self.played_positions
+        if not played_positions:
+            return None
+        if self._redo_limit < len(played_positions):  # First undo since a play
+            self._redo_limit = len(played_positions)
+        position = played_positions.popitem()[0]
+        marker_idx = len(played_positions) % 2
+        line_counts = self._line_counts
+        for slot in self._line_slots[position][marker_idx]:
+            if line_counts[slot] == 3:
+                self._completed -= 1 << 4*marker_idx
+            line_counts[slot] -= 1
+        if self._redo is None:
+            self._redo = [None]*9
+        self._redo[len(played_positions)] = position
+        return position
+    def redo(self) -> Optional[str]:
+        '''Replays the last undone move; returns its marker, or None if there is none.'''
+        plays = len(self.played_positions)
+        if plays >= self._redo_limit:
+            return None
+        return self._apply(self._redo[plays])
+    def get_winning_player(self) -> Optional[str]:
+        if self._completed & 0b1111:  # First marker takes precedence, as before
+            return self.markers[0]
+        if self._completed:
+            return self.markers[1]
+        return None
+
+class BitGrid:
+    '''Compact alternative to Grid: one 9-bit integer per marker, bit i set
+       when that marker occupies position i (textual_positions order).'''
+    __slots__ = ('markers', '_bits_1', '_bits_2', '_plays', '_grid_str')
+    textual_positions = Grid.textual_positions
+    rows = columns = k = 3
+    position_bits = {posn: 1 << idx for idx, posn in enumerate(textual_positions)}
+    winning_masks = (0b001001001, 0b010010010, 0b100100100,  # Down
+                     0b000000111, 0b000111000, 0b111000000,  # Across
+                     0b100010001, 0b001010100)  # Diagonal
+    def __init__(self, markers: str = "XO") -> None:
+        if len(markers) != 2:
+            raise InvalidMarkers()
+        if markers[0] == markers[1]:
+            raise InvalidMarkers()
+        self.markers = markers
+        self._bits_1 = 0
+        self._bits_2 = 0
+        self._plays = 0
+        self._grid_str = " "*9
+    def is_empty(self) -> bool:
+        return self._plays == 0
+    def is_full(self) -> bool:
+        return self._plays == 9
+    def get_grid(self) -> str:
+        if self._grid_str is None:  # Only rebuilt after a play
+            first, second = self.markers
+            self._grid_str = "".join(first if self._bits_1 >> idx & 1 else
+                                     second if self._bits_2 >> idx & 1 else " "
+                                     for idx in range(9))
+        return self._grid_str
+    def __str__(self) -> str:
+        return self.get_grid()
+    def play(self, position: str) -> Optional[str]:
+        bit = self.position_bits.get(position)
+        if bit is None:
+            return None
+        return self._play_bit(bit)
+    def play_index(self, idx: int) -> Optional[str]:
+        if not 0 <= idx < 9:
+            return None
+        return self._play_bit(1 << idx)
+    def _play_bit(self, bit: int) -> Optional[str]:
+        if (self._bits_1 | self._bits_2) & bit:
+            return None
+        plays = self._plays
+        if plays & 1:
+            self._bits_2 |= bit
+        else:
+            self._bits_1 |= bit
+        self._plays = plays + 1
+        self._grid_str = None
+        return self.markers[plays & 1]
+    def get_winning_player(self) -> Optional[str]:
+        if self._plays < 5:
+            return None
+        for marker, bits in zip(self.markers, (self._bits_1, self._bits_2)):
+            for mask in self.winning_masks:
+                if bits & mask == mask:
+                    return marker
+        return None
+
+class MNKGrid:
+    '''Grid of rows x columns positions, indexed row by row, where k in a row
+       wins. Grid is the rows=columns=k=3 case, with textual positions.'''
+    directions = ((0, 1), (1, 0), (1, 1), (1, -1))  # Across, down, both diagonals
+    def __init__(self, rows: int = 3, columns: int = 3, k: int = 3, markers: str = "XO") -> None:
+        if len(markers) != 2:
+            raise InvalidMarkers()
+        if markers[0] == markers[1]:
+            raise InvalidMarkers()
+        if rows < 1 or columns < 1 or not 1 <= k <= max(rows, columns):
+            raise ValueError("Invalid board of %dx%d with %d in a row" % (rows, columns, k))
+        self.rows = rows
+        self.columns = columns
+        self.k = k
+        self.markers = markers
+        self._cells = [" "] * (rows * columns)
+        self._plays = 0
+        self._completed_lines = {marker: 0 for marker in markers}
+        self._history = [0] * (rows * columns)  # Indices in play order, as in Grid
+        self._redo_limit = 0
+    def is_empty(self) -> bool:
+        return self._plays == 0
+    def is_full(self) -> bool:
+        return self._plays == len(self._cells)
+    def get_grid(self) -> str:
+        return "".join(self._cells)
+    def __str__(self) -> str:
+        return self.get_grid()
+    def index(self, row: int, column: int) -> int:
+        return row * self.columns + column
+    def play_index(self, idx: int) -> Optional[str]:
+        if not 0 <= idx < len(self._cells):
+            return None
+        if self._cells[idx] != " ":
+            return None
+        marker = self._apply(idx)
+        self._redo_limit = self._plays
+        return marker
+    def _apply(self, idx: int) -> str:
+        marker = self.markers[self._plays % 2]
+        self._cells[idx] = marker
+        self._history[self._plays] = idx
+        self._plays += 1
+        if self._is_winning_play(idx, marker):
+            self._completed_lines[marker] += 1
+        return marker
+    def undo(self) -> Optional[int]:
+        '''Takes back the last move; returns its index, or None if there is none.'''
+        if self._plays == 0:
+            return None
+        self._plays -= 1
+        idx = self._history[self._plays]
+        marker = self._cells[idx]
+        if self._is_winning_play(idx, marker):  # Board is as it was after this move
+            self._completed_lines[marker] -= 1
+        self._cells[idx] = " "
+        return idx
+    def redo(self) -> Optional[str]:
+        '''Replays the last undone move; returns its marker, or None if there is none.'''
+        if self._plays == self._redo_limit:
+            return None
+        return self._apply(self._history[self._plays])
+    def _is_winning_play(self, idx: int, marker: str) -> bool:
+        '''Counts marker's run through idx in each of the four directions only.'''
+        row, column = divmod(idx, self.columns)
+        for row_step, column_step in self.directions:
+            run = 1
+            for sign in (1, -1):
+                r, c = row + sign*row_step, column + sign*column_step
+                while (0 <= r < self.rows and 0 <= c < self.columns
+                       and self._cells[r*self.columns + c] == marker):
+                    run += 1
+                    r, c = r + sign*row_step, c + sign*column_step
+            if run >= self.k:
+                return True
+        return False
+    def get_winning_player(self) -> Optional[str]:
+        for marker in self.markers:  # First marker takes precedence, as with Grid
+            if self._completed_lines[marker]:
+                return marker
+        return None
+
+class BatchGrid:
+    '''Many grids played in lockstep, held as an (N, 9) NumPy array with 0 for
+       an empty position, 1 for the first marker and 2 for the second.'''
+    def __init__(self, size: int, markers: str = "XO") -> None:
+        if np is None:
+            raise ImportError("BatchGrid requires numpy")
+        if len(markers) != 2:
+            raise InvalidMarkers()
+        if markers[0] == markers[1]:
+            raise InvalidMarkers()
+        self.markers = markers
+        self.cells = np.zeros((size, 9), dtype=np.int8)
+        self.plays = np.zeros(size, dtype=np.int8)
+        self._rows = np.arange(size)
+        self._bit_values = 1 << np.arange(9, dtype=np.int16)
+        self._is_winning_bits = np.array([any(bits & mask == mask for mask in BitGrid.winning_masks)
+                                          for bits in range(512)])
+    def __len__(self) -> int:
+        return len(self.plays)
+    def is_empty(self) -> 'np.ndarray':
+        return self.plays == 0
+    def is_full(self) -> 'np.ndarray':
+        return self.plays == 9
+    def play(self, moves) -> 'np.ndarray':
+        '''Plays moves[i] (a position index, or -1 to pass) on grid i. Returns the
+           marker code played on each grid, or 0 where the move was rejected.'''
+        moves = np.asarray(moves)
+        valid = (moves >= 0) & (moves < 9)
+        moves = np.where(valid, moves, 0)
+        valid &= self.cells[self._rows, moves] == 0
+        played = np.where(valid, (self.plays & 1) + 1, 0).astype(np.int8)
+        self.cells[self._rows[valid], moves[valid]] = played[valid]
+        self.plays += valid
+        return played
+    def get_winning_players(self) -> 'np.ndarray':
+        '''Returns the code of each grid's winner, or 0; the first marker takes
+           precedence as in Grid.get_winning_player.'''
+        return self._winners(self.cells)
+    def get_winning_player(self, idx: int) -> Optional[str]:
+        winner = self._winners(self.cells[idx:idx+1])[0]
+        return self.markers[winner - 1] if winner else None
+    def _winners(self, cells: 'np.ndarray') -> 'np.ndarray':
+        first_won = self._is_winning_bits[(cells == 1) @ self._bit_values]
+        second_won = self._is_winning_bits[(cells == 2) @ self._bit_values]
+        return np.where(first_won, 1, np.where(second_won, 2, 0)).astype(np.int8)
+    def get_grid(self, idx: int) -> str:
+        symbols = " " + self.markers
+        return "".join(symbols[code] for code in self.cells[idx])
+
+class DecisionStats:
+    '''Opt-in counters of calls, hits and cumulative nanoseconds, for each of
+       TTTComputer's decision stages (a hit being the stage choosing the move),
+       its cache lookups if caching, and, once instrument_grid() is called, for
+       Grid.play and Grid.get_winning_player (a hit being a non-None result).'''
+    grid_methods = ('play', 'get_winning_player')
+    _instrumented = {}  # type: Dict[type, DecisionStats]  # Grid classes, by any instance
+    def __init__(self) -> None:
+        self.counters = {}  # type: Dict[str, List[int]]
+        self._originals = {}  # type: Dict[str, Optional[object]]
+        self._grid_class = None  # type: Optional[type]
+    def record(self, name: str, hit: bool, nanoseconds: int) -> None:
+        counter = self.counters.get(name)
+        if counter is None:
+            counter = self.counters[name] = [0, 0, 0]
+        counter[0] += 1
+        counter[1] += hit
+        counter[2] += nanoseconds
+    def reset(self) -> None:
+        self.counters.clear()
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        return {name: {"calls": calls, "hits": hits, "ns": nanoseconds}
+                for name, (calls, hits, nanoseconds) in self.counters.items()}
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), sort_keys=True)
+    def instrument_grid(self, grid_class: type = Grid) -> None:
+        '''Wraps grid_class's play and get_winning_player with timers until
+           restore_grid() is called; uninstrumented, they are untouched.'''
+        if self._grid_class is not None:
+            raise RuntimeError("%s is already instrumented" % self._grid_class.__name__)
+        for instrumented in self._instrumented:  # Methods are shared through inheritance too
+            if issubclass(grid_class, instrumented) or issubclass(instrumented, grid_class):
+                raise RuntimeError("%s is already instrumented" % instrumented.__name__)
+        self._instrumented[grid_class] = self
+        self._grid_class = grid_class
+        for method_name in self.grid_methods:
+            original = getattr(grid_class, method_name)
+            # None if inherited, so restoring leaves it inherited rather than pinned
+            self._originals[method_name] = grid_class.__dict__.get(method_name)
+            setattr(grid_class, method_name,
+                    self._timed(original, "%s.%s" % (grid_class.__name__, method_name)))
+    def restore_grid(self) -> None:
+        if self._grid_class is None:
+            return
+        for method_name, original in self._originals.items():
+            if original is None:
+                delattr(self._grid_class, method_name)
+            else:
+                setattr(self._grid_class, method_name, original)
+        self._originals.clear()
+        del self._instrumented[self._grid_class]
+        self._grid_class = None
+    def _timed(self, method, name: str):
+        def timed(*args, **kwargs):
+            start_ns = time.perf_counter_ns()
+            result = method(*args, **kwargs)
+            self.record(name, result is not None, time.perf_counter_ns() - start_ns)
+            return result
+        return timed
+
+def _first_fork(fork_bits: int) -> int:
+    '''Returns the fork position played, given the fork positions as bits, or -1.
+       They used to be found as a set, the move played being the first iterated:
+       CPython places small ints in a set by value modulo 8, so in a set of up to
+       four positions 8 comes first unless 0 (always found before 8) is there too;
+       a set of five or more is resized and iterates in ascending order.'''
+    forks = [idx for idx in range(9) if fork_bits >> idx & 1]
+    if not forks:
+        return -1
+    if forks[-1] == 8 and forks[0] != 0 and len(forks) < 5:
+        return 8
+    return forks[0]
+
+class TTTComputer:
+    # The winning lines (diagonals, then across and down in turn), and the indices
+    # of the lines through each position
+    lines = ((0, 4, 8), (2, 4, 6), (0, 1, 2), (0, 3, 6), (3, 4, 5), (1, 4, 7), (6, 7, 8), (2, 5, 8))
+    cell_lines = ((0, 2, 3), (2, 5), (1, 2, 7), (3, 4), (0, 1, 4, 5), (4, 7), (1, 3, 6), (5, 6), (0, 6, 7))
+    _no_counts = (0,)*8
+    first_fork = tuple(map(_first_fork, range(512)))  # By fork positions as bits
+    def __init__(self, table: Optional['PerfectPlayTable'] = None,
+                 cache_size: Optional[int] = None,
+                 stats: Optional['DecisionStats'] = None) -> None:
+        '''cache_size, if given, enables an LRU cache of up to that many moves;
+           stats, if given, records each decision stage tried.'''
+        self.table = table
+        self._counted_grid = None  # type: Optional[str]
+        self._counts = {}  # type: Dict[str, List[int]]
+        if cache_size is not None and cache_size < 1:
+            raise ValueError("cache_size must be at least 1")
+        self.cache_size = cache_size
+        self._cache = None if cache_size is None else OrderedDict()  # type: Optional[OrderedDict]
+        self._cache_hits = self._cache_misses = self._cache_evictions = 0
+        self.stats = stats
+        # The rule cascade, in order; each returns an index to play or None
+        self._stages = [('win', self._win_move), ('block', self._block_move),
+                        ('fork', self._fork_move), ('block_fork', self._block_fork_move),
+                        ('center', self._center_move), ('sequential', self._sequential_move)]
+    @property
+    def triples(self) -> List[Set[int]]:
+        '''The winning lines as sets of positions, as before the line counts.'''
+        return [set(line) for line in self.lines]
+    def play_on_grid(self, grid: Grid, with_mark: str, vs_mark: str) -> None:
+        grid_s = grid.get_grid()
+        if self._cache is None:
+            move = self._choose_move(grid_s, with_mark, vs_mark)
+        else:
+            key = (grid_s, with_mark, vs_mark)
+            start_ns = 0 if self.stats is None else time.perf_counter_ns()
+            if key in self._cache:
+                self._cache_hits += 1
+                self._cache.move_to_end(key)
+                move = self._cache[key]
+                if self.stats is not None:
+                    self.stats.record('cache', True, time.perf_counter_ns() - start_ns)
+            else:
+                if self.stats is not None:
+                    self.stats.record('cache', False, time.perf_counter_ns() - start_ns)
+                self._cache_misses += 1
+                move = self._cache[key] = self._choose_move(grid_s, with_mark, vs_mark)
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)  # Least recently used
+                    self._cache_evictions += 1
+        if move is not None:
+            grid.play(Grid.textual_positions[move])
+    def cache_info(self) -> Dict[str, Optional[int]]:
+        return {"hits": self._cache_hits, "misses": self._cache_misses,
+                "evictions": self._cache_evictions,
+                "size": 0 if self._cache is None else len(self._cache),
+                "max_size": self.cache_size}
+    def cache_clear(self) -> None:
+        if self._cache is not None:
+            self._cache.clear()
+        self._cache_hits = self._cache_misses = self._cache_evictions = 0
+    def _choose_move(self, grid_s: str, with_mark: str, vs_mark: str) -> Optional[int]:
+        if self.stats is not None:
+            return self._choose_move_instrumented(grid_s, with_mark, vs_mark)
+        move = None
+        if self.table is not None:
+            move = self.table.get_move(grid_s, with_mark, vs_mark)
+        if move is None:  # No table, or position unreachable in a game (eg. already won)
+            move = self._heuristic_move(grid_s, with_mark, vs_mark)
+        return move
+    def _choose_move_instrumented(self, grid_s: str, with_mark: str, vs_mark: str) -> Optional[int]:
+        '''As _choose_move, recording each stage tried into self.stats.'''
+        stages = self._stages
+        if self.table is not None:
+            stages = [('table', self.table.get_move)] + stages
+        for stage, choose in stages:
+            start_ns = time.perf_counter_ns()
+            move = choose(grid_s, with_mark, vs_mark)
+            self.stats.record(stage, move is not None, time.perf_counter_ns() - start_ns)
+            if move is not None:
+                return move
+        return None
+    def _heuristic_move(self, grid_s: str, with_mark: str, vs_mark: str) -> Optional[int]:
+        '''Returns the index to play from the rule cascade, or None if the grid is full.'''
+        for stage, choose in self._stages:
+            move = choose(grid_s, with_mark, vs_mark)
+            if move is not None:
+                return move
+        return None
+    def _win_move(self, grid_s: str, with_mark: str, vs_mark: str) -> Optional[int]:
+        return self._try_to_win(grid_s, with_mark)
+    def _block_move(self, grid_s: str, with_mark: str, vs_mark: str) -> Optional[int]:
+        avoid_loss_move = self._try_to_avoid_loss(grid_s, vs_mark)
+        if avoid_loss_move:  # Non-empty list
+            return avoid_loss_move[0]  # Might be forked, play anyhow
+        return None
+    def _fork_move(self, grid_s: str, with_mark: str, vs_mark: str) -> Optional[int]:
+        fork_move_for_me = self._detect_fork_move_for_mark(grid_s, with_mark, vs_mark)
+        if fork_move_for_me:  # Non-empty list
+            return fork_move_for_me[0]
+        return None
+    def _block_fork_move(self, grid_s: str, with_mark: str, vs_mark: str) -> Optional[int]:
+        fork_move_for_opponent = self._detect_fork_move_for_mark(grid_s, vs_mark, with_mark)
+        if fork_move_for_opponent:  # Non-empty list
+            return fork_move_for_opponent[0]
+        return None
+    def _center_move(self, grid_s: str, with_mark: str, vs_mark: str) -> Optional[int]:
+        # If center is not taken, take it, except on first move
+        if grid_s[4] == " " and grid_s != " "*9:
+            return 4
+        return None
+    def _sequential_move(self, grid_s: str, with_mark: str, vs_mark: str) -> Optional[int]:
+        # Play in next available space
+        for sequential_move in range(0, 9):
+            if grid_s[sequential_move] == " ":
+                return sequential_move
+        return None
+    def _line_counts(self, grid_str: str) -> Dict[str, List[int]]:
+        '''Returns, for each marker played, how many of each line's positions hold
+           it; counted once per position and shared by the heuristics.'''
+        if grid_str != self._counted_grid:
+            counts = {}  # type: Dict[str, List[int]]
+            for entry, lines in zip(grid_str, self.cell_lines):
+                if entry != " ":
+                    entry_counts = counts.get(entry)
+                    if entry_counts is None:
+                        entry_counts = counts[entry] = [0]*8
+                    for line in lines:
+                        entry_counts[line] += 1
+            self._counted_grid, self._counts = grid_str, counts
+        return self._counts
+    def _try_to_win(self, grid_str: str, with_mark: str) -> Optional[int]:
+        '''Tries to find a move to win; if so, returns index, otherwise None.'''
+        my_counts = self._line_counts(grid_str).get(with_mark, self._no_counts)
+        if 2 in my_counts:
+            for line, cells in enumerate(self.lines):
+                if my_counts[line] == 2:
+                    for cell in cells:
+                        if grid_str[cell] == " ":  # First of several if a fork was not blocked
+                            return cell
+        return None
+    def _try_to_avoid_loss(self, grid_str: str, vs_mark: str) -> List[int]:
+        '''Tries to find if a position must be played to block an opponent's win.
+           If so, returns those indices (one per line), otherwise an empty list.'''
+        vs_counts = self._line_counts(grid_str).get(vs_mark, self._no_counts)
+        if 2 not in vs_counts:
+            return []
+        return [cell for line, cells in enumerate(self.lines) if vs_counts[line] == 2
+                for cell in cells if grid_str[cell] == " "]
+    def _detect_fork_move_for_mark(self, grid_str: str, mark: str, other_mark: str) -> List[int]:
+        '''Tries to find positions where 'mark' can fork, ie. which are on two
+           lines holding 'mark' but not 'other_mark'. Returns them, or an empty list.'''
+        counts = self._line_counts(grid_str)
+        mark_counts = counts.get(mark, self._no_counts)
+        other_counts = counts.get(other_mark, self._no_counts)
+        open_lines = [0]*9  # Through each position, of the lines 'mark' could still complete
+        for line, cells in enumerate(self.lines):
+            if mark_counts[line] and not other_counts[line]:
+                for cell in cells:
+                    open_lines[cell] += 1
+        forks = [cell for cell in range(9) if open_lines[cell] >= 2 and grid_str[cell] != mark]
+        if len(forks) > 1:  # The first is played, so must be as it always was
+            first = self.first_fork[sum(1 << cell for cell in forks)]
+            forks.remove(first)
+            forks.insert(0, first)
+        return forks
+
+class BatchComputer:
+    '''TTTComputer's rule cascade (without a table) for many positions at once,
+       encoded as in BatchGrid; each stage is evaluated for every board using
+       line masks, and the moves match TTTComputer.play_on_grid.'''
+    def __init__(self) -> None:
+        if np is None:
+            raise ImportError("BatchComputer requires numpy")
+        self._incidence = np.zeros((8, 9), dtype=np.float32)  # Line by position; float for BLAS
+        for line, cells in enumerate(TTTComputer.lines):
+            self._incidence[line, list(cells)] = 1
+        self._positions = np.arange(9, dtype=np.float32)
+        self._bit_values = 1 << np.arange(9, dtype=np.int16)
+        self._first_fork = np.array(TTTComputer.first_fork, dtype=np.int8)
+    @staticmethod
+    def encode(grid_strs: Iterable[str], markers: str = "XO") -> 'np.ndarray':
+        '''Encodes grid strings as an (N, 9) array, as BatchGrid.cells.'''
+        entries = np.array(list("".join(grid_strs)), dtype='U1').reshape(-1, 9)
+        return ((entries == markers[0]) + 2 * (entries == markers[1])).astype(np.int8)
+    def moves(self, cells, with_codes=None) -> 'np.ndarray':
+        '''Returns the position index to play on each board, or -1 if it is full.
+           with_codes (1 or 2, per board or for all) defaults to whoever's turn it is.'''
+        cells = np.asarray(cells, dtype=np.int8).reshape(-1, 9)
+        if with_codes is None:
+            with_codes = np.where(np.count_nonzero(cells, axis=1) % 2 == 0, 1, 2)
+        with_codes = np.broadcast_to(np.asarray(with_codes, dtype=np.int8), (len(cells),))
+        mine = cells == with_codes[:, None]
+        theirs = cells == (3 - with_codes)[:, None]
+        empty = cells == 0
+        line_mine = mine.astype(np.float32) @ self._incidence.T
+        line_theirs = theirs.astype(np.float32) @ self._incidence.T
+        line_empty = empty.astype(np.float32) @ self._incidence.T
+        # The empty position of each line, where a line has exactly one
+        line_gap = (empty * self._positions) @ self._incidence.T
+        rows = np.arange(len(cells))
+        def first_line_gap(line_counts: 'np.ndarray') -> Tuple['np.ndarray', 'np.ndarray']:
+            lines = (line_counts == 2) & (line_empty == 1)
+            return lines.any(axis=1), line_gap[rows, lines.argmax(axis=1)].astype(np.int8)
+        def fork(mark: 'np.ndarray', line_mark: 'np.ndarray',
+                 line_other: 'np.ndarray') -> Tuple['np.ndarray', 'np.ndarray']:
+            open_lines = ((line_mark > 0) & (line_other == 0)).astype(np.float32) @ self._incidence
+            forks = (open_lines >= 2) & ~mark
+            first_fork = self._first_fork[forks @ self._bit_values]  # As TTTComputer
+            return first_fork >= 0, first_fork
+        stages = [first_line_gap(line_mine), first_line_gap(line_theirs),
+                  fork(mine, line_mine, line_theirs), fork(theirs, line_theirs, line_mine),
+                  (empty[:, 4] & ~empty.all(axis=1), np.full(len(cells), 4)),
+                  (empty.any(axis=1), empty.argmax(axis=1))]
+        moves = np.full(len(cells), -1, dtype=np.int8)
+        for found, stage_moves in reversed(stages):  # Earlier stages take precedence
+            moves = np.where(found, stage_moves, moves).astype(np.int8)
+        return moves
+    def play_on_batch(self, batch: 'BatchGrid') -> 'np.ndarray':
+        '''Plays the move for whoever's turn it is on every grid; returns as BatchGrid.play.'''
+        return batch.play(self.moves(batch.cells, (batch.plays & 1) + 1))
+
+class PerfectPlayTable:
+    '''Minimax moves for every position reachable in a game, computed once per
+       symmetry class of the board. Positions are keyed relative to the player
+       to move: 'M' for their marks, 'T' for the opponent's, ' ' if empty.'''
+    version = 1
+    canonical_positions = 627  # Including those with either side to move first
+    symmetries = ((0, 1, 2, 3, 4, 5, 6, 7, 8), (6, 3, 0, 7, 4, 1, 8, 5, 2),  # Rotations
+                  (8, 7, 6, 5, 4, 3, 2, 1, 0), (2, 5, 8, 1, 4, 7, 0, 3, 6),
+                  (2, 1, 0, 5, 4, 3, 8, 7, 6), (6, 7, 8, 3, 4, 5, 0, 1, 2),  # Reflections
+                  (0, 3, 6, 1, 4, 7, 2, 5, 8), (8, 5, 2, 7, 4, 1, 6, 3, 0))
+    def __init__(self, canonical_moves: Dict[str, int]) -> None:
+        '''canonical_moves maps each canonical position to a bitmask of its best
+           moves; every orientation is expanded here so that a lookup needs no
+           canonicalization. Where TTTComputer's rule cascade already picks one
+           of the best moves that is kept, otherwise the lowest index is used.'''
+        self.canonical_moves = canonical_moves
+        self._moves = {}  # type: Dict[str, int]
+        heuristics = TTTComputer()
+        for position, best_mask in canonical_moves.items():
+            for perm in self.symmetries:
+                oriented = self._orient(position, perm)
+                oriented_mask = self._orient_mask(best_mask, perm)
+                move = heuristics._heuristic_move(oriented, 'M', 'T')
+                if not oriented_mask >> move & 1:
+                    move = (oriented_mask & -oriented_mask).bit_length() - 1
+                self._moves[oriented] = move
+        self._relative_tables = {}  # type: Dict[Tuple[str, str], Dict[int, str]]
+    def __len__(self) -> int:
+        return len(self._moves)
+    def get_move(self, grid_str: str, with_mark: str, vs_mark: str) -> Optional[int]:
+        '''Returns the index to play for with_mark, or None if the position is
+           not one reachable in a game with with_mark to move.'''
+        relative = self._relative_tables.get((with_mark, vs_mark))
+        if relative is None:
+            relative = str.maketrans({with_mark: 'M', vs_mark: 'T'})
+            self._relative_tables[(with_mark, vs_mark)] = relative
+        return self._moves.get(grid_str.translate(relative))
+    @staticmethod
+    def _orient(position: str, perm: Tuple[int, ...]) -> str:
+        return "".join(position[src] for src in perm)
+    @staticmethod
+    def _orient_mask(mask: int, perm: Tuple[int, ...]) -> int:
+        return sum(1 << dst for dst, src in enumerate(perm) if mask >> src & 1)
+    @classmethod
+    def canonical(cls, position: str) -> str:
+        return min(cls._orient(position, perm) for perm in cls.symmetries)
+    _outcomes = {}  # type: Dict[Tuple[int, int], int]  # Memo shared by all tables
+    @staticmethod
+    def _is_win(bits: int) -> bool:
+        return any(bits & mask == mask for mask in BitGrid.winning_masks)
+    @staticmethod
+    def _free_cells(mine: int, theirs: int) -> List[int]:
+        return [idx for idx in range(9) if not (mine | theirs) >> idx & 1]
+    @classmethod
+    def _move_outcome(cls, mine: int, theirs: int, idx: int) -> int:
+        '''1 if playing idx wins for the player to move, 0 for a draw, -1 to lose.'''
+        mine |= 1 << idx
+        if cls._is_win(mine):
+            return 1
+        if mine | theirs == 0b111111111:
+            return 0
+        return -cls._negamax(theirs, mine)
+    @classmethod
+    def _negamax(cls, mine: int, theirs: int) -> int:
+        if (mine, theirs) not in cls._outcomes:
+            cls._outcomes[(mine, theirs)] = max(cls._move_outcome(mine, theirs, idx)
+                                                for idx in cls._free_cells(mine, theirs))
+        return cls._outcomes[(mine, theirs)]
+    @classmethod
+    def outcome(cls, grid_str: str, with_mark: str, vs_mark: str) -> int:
+        '''Outcome under perfect play for with_mark, who is to move in a game not
+           yet won: 1 for a win, 0 for a draw, -1 for a loss.'''
+        mine = sum(1 << idx for idx, entry in enumerate(grid_str) if entry == with_mark)
+        theirs = sum(1 << idx for idx, entry in enumerate(grid_str) if entry == vs_mark)
+        if mine | theirs == 0b111111111:
+            return 0
+        return cls._negamax(mine, theirs)
+    @classmethod
+    def move_outcome(cls, grid_str: str, with_mark: str, vs_mark: str, idx: int) -> int:
+        '''As outcome, after with_mark plays at idx.'''
+        mine = sum(1 << i for i, entry in enumerate(grid_str) if entry == with_mark)
+        theirs = sum(1 << i for i, entry in enumerate(grid_str) if entry == vs_mark)
+        return cls._move_outcome(mine, theirs, idx)
+    @classmethod
+    def build(cls) -> 'PerfectPlayTable':
+        '''Every move achieving the minimax outcome (win, draw or loss) is kept.'''
+        is_win, free_cells = cls._is_win, cls._free_cells
+        move_outcome, negamax = cls._move_outcome, cls._negamax
+        def to_str(mine: int, theirs: int) -> str:
+            return "".join('M' if mine >> idx & 1 else 'T' if theirs >> idx & 1 else ' '
+                           for idx in range(9))
+        canonical_moves = {}  # type: Dict[str, int]
+        pending = [(0, 0)]  # Both sides to move first, as roles swap each ply
+        while pending:
+            mine, theirs = pending.pop()
+            position = to_str(mine, theirs)
+            perm = min(cls.symmetries, key=lambda perm: cls._orient(position, perm))
+            key = cls._orient(position, perm)
+            if key in canonical_moves:
+                continue
+            best = negamax(mine, theirs)
+            best_mask = sum(1 << idx for idx in free_cells(mine, theirs)
+                            if move_outcome(mine, theirs, idx) == best)
+            canonical_moves[key] = cls._orient_mask(best_mask, perm)
+            for idx in free_cells(mine, theirs):
+                played = mine | 1 << idx
+                if not is_win(played) and played | theirs != 0b111111111:
+                    pending.append((theirs, played))
+        return cls(canonical_moves)
+    @classmethod
+    def load(cls, path: str) -> 'PerfectPlayTable':
+        '''Raises ValueError unless path holds a table of this version with a move
+           mask for every canonical position, and nothing else.'''
+        with open(path) as cache_file:
+            cache = json.load(cache_file)
+        if not isinstance(cache, dict) or cache.get("version") != cls.version:
+            raise ValueError("Unsupported table version in %s" % path)
+        positions = cache.get("positions")
+        if not isinstance(positions, dict) or len(positions) != cls.canonical_positions:
+            raise ValueError("Incomplete table in %s" % path)
+        for position, mask in positions.items():
+            if (len(position) != 9 or position.strip("MT ") != ""
+                    or cls.canonical(position) != position
+                    or type(mask) is not int or not 0 < mask < 1 << 9):
+                raise ValueError("Malformed table entry %r in %s" % (position, path))
+        return cls(positions)
+    def save(self, path: str) -> None:
+        '''Writes to a temporary file beside path, then moves it into place, so an
+           interrupted save never leaves a truncated cache.'''
+        descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+                                                 prefix=".table-", suffix=".json")
+        try:
+            with os.fdopen(descriptor, "w") as cache_file:
+                json.dump({"version": self.version, "positions": self.canonical_moves}, cache_file)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+    _shared = None  # type: Optional[PerfectPlayTable]
+    @classmethod
+    def shared(cls) -> 'PerfectPlayTable':
+        '''A table built on first use, then kept for the rest of the process.'''
+        if cls._shared is None:
+            cls._shared = cls.build()
+        return cls._shared
+    @classmethod
+    def load_or_build(cls, path: Optional[str] = None) -> 'PerfectPlayTable':
+        '''Uses the on-disk cache at path if present and readable, otherwise builds
+           the table and, if a path was given, saves it there.'''
+        if path is not None and os.path.exists(path):
+            try:
+                return cls.load(path)
+            except ValueError:  # Unreadable, malformed or old; rebuilt below
+                pass
+        table = cls.build()
+        if path is not None:
+            table.save(path)
+        return table
+
+class _SearchTimeout(Exception):
+    pass
+
+class _MCTSNode:
+    __slots__ = ('move', 'parent', 'children', 'untried', 'visits', 'score')
+    def __init__(self, parent: Optional['_MCTSNode'], move: Optional[int], untried: List[int]) -> None:
+        self.move = move
+        self.parent = parent
+        self.children = []  # type: List[_MCTSNode]
+        self.untried = untried
+        self.visits = 0
+        self.score = 0.0  # For the player who made 'move'; a draw scores half
+
+class SearchComputer:
+    '''Search-based player for Grid or any MNKGrid, with the same play_on_grid
+       interface as TTTComputer. Plays for whichever marker is next to move.
+       mode is 'alphabeta' (iterative deepening with a transposition table)
+       or 'mcts' (UCT with random playouts); both stop after time_budget
+       seconds. Candidate moves are those within 'radius' of a played
+       position, except on boards of up to 25 positions where all are tried.
+       table, if given, is used in place of searching on 3x3 boards with k=3.
+       On those, alphabeta never loses within the default budget; mcts only
+       reliably does so when given a table.'''
+    modes = ('alphabeta', 'mcts')
+    win_score = 1000000
+    def __init__(self, mode: str = 'alphabeta', time_budget: float = 0.1, radius: int = 1,
+                 seed: Optional[int] = None, max_table_size: int = 1000000,
+                 table: Optional[PerfectPlayTable] = None) -> None:
+        if mode not in self.modes:
+            raise ValueError("Unknown search mode %r" % mode)
+        self.mode = mode
+        self.table = table
+        self.time_budget = time_budget
+        self.radius = radius
+        self.random = random.Random(seed)
+        self.max_table_size = max_table_size
+        self.last_search = {}  # type: Dict[str, float]
+        self._dimensions = None  # type: Optional[Tuple[int, int, int]]
+        self._transpositions = {}  # type: Dict[int, Tuple[int, int, int, Optional[int]]]
+        self._zobrist = []  # type: List[Tuple[int, int]]
+        self._history = []  # type: List[int]
+        self._deadline = 0.0
+        self._nodes = 0
+    def play_on_grid(self, grid, with_mark: str, vs_mark: str) -> None:
+        board = self._replica(grid)
+        if board.get_winning_player() is not None or board.is_full():
+            return
+        start_time = time.perf_counter()
+        self._deadline = start_time + self.time_budget
+        self._nodes = 0
+        grid_s = board.get_grid()
+        candidates = self._candidates(board, grid_s)
+        move, depth = None, 0
+        if self.table is not None and (board.rows, board.columns, board.k) == (3, 3, 3):
+            mover = board._plays % 2
+            move = self.table.get_move(grid_s, board.markers[mover], board.markers[1 - mover])
+        if move is not None:
+            pass  # From the table
+        elif len(candidates) == 1:
+            move = candidates[0]
+        elif self.mode == 'alphabeta':
+            move, depth = self._iterative_deepening(board)
+        else:
+            move, depth = self._mcts(board)
+        seconds = time.perf_counter() - start_time
+        self.last_search = {"nodes": self._nodes, "depth": depth, "seconds": seconds,
+                            "nodes_per_second": self._nodes / seconds if seconds else 0.0}
+        grid.play_index(move)
+    def _replica(self, grid) -> MNKGrid:
+        '''Copies grid into an MNKGrid, the search then playing and undoing on it.'''
+        dimensions = (grid.rows, grid.columns, grid.k)
+        if dimensions != self._dimensions:  # New board size; transpositions don't carry over
+            self._dimensions = dimensions
+            self._transpositions.clear()
+            self._zobrist = [(self.random.getrandbits(64), self.random.getrandbits(64))
+                             for _ in range(grid.rows * grid.columns)]
+            self._history = [0] * (grid.rows * grid.columns)
+        board = MNKGrid(grid.rows, grid.columns, grid.k, grid.markers)
+        grid_s = grid.get_grid()
+        first = [idx for idx, entry in enumerate(grid_s) if entry == grid.markers[0]]
+        second = [idx for idx, entry in enumerate(grid_s) if entry == grid.markers[1]]
+        for turn in range(len(first) + len(second)):
+            board.play_index((first, second)[turn % 2][turn // 2])
+        return board
+    def _candidates(self, board: MNKGrid, grid_s: str) -> List[int]:
+        if len(grid_s) <= 25:
+            return [idx for idx, entry in enumerate(grid_s) if entry == " "]
+        rows, columns, radius = board.rows, board.columns, self.radius
+        played = [idx for idx, entry in enumerate(grid_s) if entry != " "]
+        if not played:
+            return [board.index(rows // 2, columns // 2)]
+        near = set()
+        for idx in played:
+            row, column = divmod(idx, columns)
+            for r in range(max(0, row - radius), min(rows, row + radius + 1)):
+                for c in range(max(0, column - radius), min(columns, column + radius + 1)):
+                    if grid_s[r*columns + c] == " ":
+                        near.add(r*columns + c)
+        if not near:  # Surrounded; fall back to anywhere
+            return [idx for idx, entry in enumerate(grid_s) if entry == " "]
+        return sorted(near)
+    def _check_time(self) -> None:
+        self._nodes += 1
+        if self._nodes & 255 == 0 and time.perf_counter() > self._deadline:
+            raise _SearchTimeout()
+    def _iterative_deepening(self, board: MNKGrid) -> Tuple[int, int]:
+        grid_s = board.get_grid()
+        key = 0
+        for idx, entry in enumerate(grid_s):
+            if entry != " ":
+                key ^= self._zobrist[idx][board.markers.index(entry)]
+        empties = grid_s.count(" ")
+        best_move, completed_depth = self._candidates(board, grid_s)[0], 0
+        try:
+            for depth in range(1, empties + 1):
+                score, move = self._negamax(board, key, depth, -2*self.win_score, 2*self.win_score)
+                best_move, completed_depth = move, depth
+                if abs(score) >= self.win_score:  # Result is known
+                    break
+        except _SearchTimeout:
+            pass
+        if len(self._transpositions) > self.max_table_size:
+            self._transpositions.clear()
+        return best_move, completed_depth
+    def _negamax(self, board: MNKGrid, key: int, depth: int, alpha: int, beta: int) -> Tuple[int, Optional[int]]:
+        '''Returns (score, best move) for the player to move, who has not yet lost.'''
+        self._check_time()
+        entry = self._transpositions.get(key)
+        table_move = None
+        if entry is not None:
+            entry_depth, entry_score, entry_bound, table_move = entry
+            if entry_depth >= depth:
+                if (entry_bound == 0 or (entry_bound > 0 and entry_score >= beta)
+                        or (entry_bound < 0 and entry_score <= alpha)):
+                    return entry_score, table_move
+        grid_s = board.get_grid()
+        if depth == 0:
+            return self._evaluate(board, grid_s), None
+        moves = self._candidates(board, grid_s)
+        history = self._history
+        moves.sort(key=lambda idx: -history[idx])
+        if table_move in moves:
+            moves.remove(table_move)
+            moves.insert(0, table_move)
+        original_alpha = alpha
+        best_score, best_move = -2*self.win_score, moves[0]
+        empties = grid_s.count(" ")
+        side = (len(grid_s) - empties) % 2
+        for idx in moves:
+            board.play_index(idx)
+            if board.get_winning_player() is not None:
+                score = self.win_score + empties  # Sooner wins leave more empty
+            elif board.is_full():
+                score = 0
+            else:
+                score = -self._negamax(board, key ^ self._zobrist[idx][side], depth - 1, -beta, -alpha)[0]
+            board.undo()
+            if score > best_score:
+                best_score, best_move = score, idx
+            alpha = max(alpha, score)
+            if alpha >= beta:
+                history[idx] += depth * depth
+                break
+        bound = 1 if best_score >= beta else -1 if best_score <= original_alpha else 0
+        self._transpositions[key] = (depth, best_score, bound, best_move)
+        return best_score, best_move
+    def _evaluate(self, board: MNKGrid, grid_s: str) -> int:
+        '''Sums squared run lengths, each run counted once, for the player to move
+           less those of the opponent.'''
+        rows, columns = board.rows, board.columns
+        mover = board.markers[(len(grid_s) - grid_s.count(" ")) % 2]
+        score = 0
+        for idx, entry in enumerate(grid_s):
+            if entry == " ":
+                continue
+            row, column = divmod(idx, columns)
+            for row_step, column_step in MNKGrid.directions:
+                r, c = row - row_step, column - column_step
+                if 0 <= r < rows and 0 <= c < columns and grid_s[r*columns + c] == entry:
+                    continue  # Not the start of this run
+                run = 1
+                r, c = row + row_step, column + column_step
+                while 0 <= r < rows and 0 <= c < columns and grid_s[r*columns + c] == entry:
+                    run += 1
+                    r, c = r + row_step, c + column_step
+                score += run*run if entry == mover else -run*run
+        return score
+    def _mcts(self, board: MNKGrid) -> Tuple[int, int]:
+        grid_s = board.get_grid()
+        root = _MCTSNode(None, None, self._candidates(board, grid_s))
+        for move in root.untried:  # Playouts are too noisy to be relied on for a win in one
+            board.play_index(move)
+            won = board.get_winning_player() is not None
+            board.undo()
+            if won:
+                return move, 1
+        opponent = board.markers[(len(grid_s) - grid_s.count(" ") + 1) % 2]
+        for move in root.untried:  # Nor to block one
+            if board._is_winning_play(move, opponent):
+                return move, 1
+        deepest = 0
+        try:
+            while True:
+                node, depth = root, 0
+                while not node.untried and node.children:  # Selection
+                    log_visits = math.log(node.visits)
+                    node = max(node.children, key=lambda child: child.score / child.visits +
+                               1.4 * math.sqrt(log_visits / child.visits))
+                    board.play_index(node.move)
+                    depth += 1
+                    self._check_time()
+                if node.untried and board.get_winning_player() is None:  # Expansion
+                    move = node.untried.pop(self.random.randrange(len(node.untried)))
+                    board.play_index(move)
+                    depth += 1
+                    self._check_time()
+                    untried = ([] if board.get_winning_player() is not None
+                               else self._candidates(board, board.get_grid()))
+                    child = _MCTSNode(node, move, untried)
+                    node.children.append(child)
+                    node = child
+                deepest = max(deepest, depth)
+                grid_s = board.get_grid()
+                moved = board.markers[(len(grid_s) - grid_s.count(" ") - 1) % 2]
+                winner = self._playout(board)
+                for _ in range(depth):
+                    board.undo()
+                while node is not None:  # Backpropagation
+                    node.visits += 1
+                    node.score += 0.5 if winner is None else 1.0 if winner == moved else 0.0
+                    moved = board.markers[1 - board.markers.index(moved)]
+                    node = node.parent
+        except _SearchTimeout:
+            pass  # The replica board is discarded, so needn't be restored
+        if not root.children:
+            return root.untried[0], 0
+        return max(root.children, key=lambda child: child.visits).move, deepest
+    def _playout(self, board: MNKGrid) -> Optional[str]:
+        '''Plays random moves to the end of the game; undoes them, returns the winner.'''
+        empty = [idx for idx, entry in enumerate(board.get_grid()) if entry == " "]
+        self.random.shuffle(empty)
+        played = 0
+        while board.get_winning_player() is None and played < len(empty):
+            board.play_index(empty[played])
+            played += 1
+            self._check_time()
+        winner = board.get_winning_player()
+        for _ in range(played):
+            board.undo()
+        return winner
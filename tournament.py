@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+from typing import Optional, List, Tuple, NamedTuple
+
+import argparse
+import multiprocessing
+import os
+import random
+import time
+
+from tictactoe import Grid, PerfectPlayTable, TTTComputer
+
+class RandomPlayer:
+    '''Plays in a random empty position; same interface as TTTComputer.'''
+    def __init__(self, seed: Optional[int] = None) -> None:
+        self.random = random.Random(seed)
+    def play_on_grid(self, grid: Grid, with_mark: str, vs_mark: str) -> None:
+        empty = [idx for idx, entry in enumerate(grid.get_grid()) if entry == " "]
+        if empty:
+            grid.play(Grid.textual_positions[self.random.choice(empty)])
+
+class TournamentResult(NamedTuple):
+    first_wins: int
+    draws: int
+    second_wins: int
+    seconds: float
+    @property
+    def games(self) -> int:
+        return self.first_wins + self.draws + self.second_wins
+    @property
+    def games_per_second(self) -> float:
+        return self.games / self.seconds if self.seconds else 0.0
+
+class Tournament:
+    '''Plays many games between two named policies across a process pool.
+       Workers only send back win/draw/loss counts for each chunk of games.'''
+    policies = {
+        'computer': lambda seed: TTTComputer(),
+        'table': lambda seed: TTTComputer(PerfectPlayTable.shared()),
+        'random': lambda seed: RandomPlayer(seed),
+    }
+    def __init__(self, processes: Optional[int] = None, chunk_size: int = 500) -> None:
+        self.processes = processes or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+    @staticmethod
+    def play_game(first, second, markers: str = "XO") -> Optional[str]:
+        '''Plays one game between two policies; returns the winning marker or None.'''
+        grid = Grid(markers)
+        turns = ((first, markers[0], markers[1]), (second, markers[1], markers[0]))
+        turn = 0
+        while grid.get_winning_player() is None and not grid.is_full():
+            player, with_mark, vs_mark = turns[turn % 2]
+            player.play_on_grid(grid, with_mark, vs_mark)
+            turn += 1
+        return grid.get_winning_player()
+    @classmethod
+    def _play_chunk(cls, chunk: Tuple[str, str, int, int]) -> Tuple[int, int, int]:
+        first_name, second_name, games, seed = chunk
+        first = cls.policies[first_name](seed)
+        second = cls.policies[second_name](seed + 1)
+        counts = {"X": 0, None: 0, "O": 0}
+        for game in range(games):
+            counts[cls.play_game(first, second)] += 1
+        return counts["X"], counts[None], counts["O"]
+    def play(self, first: str, second: str, games: int, seed: int = 0,
+             processes: Optional[int] = None) -> TournamentResult:
+        '''Plays games with policy 'first' moving first; counts are from its view.'''
+        for name in (first, second):
+            if name not in self.policies:
+                raise ValueError("Unknown policy %r" % name)
+        chunks = [(first, second, min(self.chunk_size, games - start), seed + 2*idx)
+                  for idx, start in enumerate(range(0, games, self.chunk_size))]
+        start_time = time.perf_counter()
+        with multiprocessing.Pool(processes or self.processes) as pool:
+            counts = pool.map(self._play_chunk, chunks)
+        seconds = time.perf_counter() - start_time
+        first_wins, draws, second_wins = (sum(column) for column in zip(*counts)) if counts else (0, 0, 0)
+        return TournamentResult(first_wins, draws, second_wins, seconds)
+    def scaling(self, first: str, second: str, games: int,
+                worker_counts: List[int]) -> List[Tuple[int, float, float]]:
+        '''Returns (workers, games per second, efficiency) for each worker count,
+           efficiency being the speedup over one worker divided by workers.'''
+        single = self.play(first, second, games, processes=1).games_per_second
+        report = []
+        for workers in worker_counts:
+            rate = single if workers == 1 else self.play(first, second, games, processes=workers).games_per_second
+            report.append((workers, rate, rate / (single * workers) if single else 0.0))
+        return report
+
+matchups = [('computer', 'computer'), ('computer', 'random'), ('random', 'computer')]
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Play self-play tournaments between policies.")
+    parser.add_argument("--games", type=int, default=100000, help="games per matchup")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--policy", action="append", choices=sorted(Tournament.policies),
+                        help="use in place of 'computer' (eg. 'table'); may be repeated")
+    parser.add_argument("--scaling", action="store_true",
+                        help="also report games/s and efficiency for 1..processes workers")
+    args = parser.parse_args()
+
+    tournament = Tournament(args.processes, args.chunk_size)
+    for computer in args.policy or ['computer']:
+        for first, second in matchups:
+            first, second = (computer if name == 'computer' else name for name in (first, second))
+            result = tournament.play(first, second, args.games, args.seed)
+            print("%-8s vs %-8s %9d games: first %7d  draw %7d  second %7d  %10.0f games/s"
+                  % (first, second, result.games, result.first_wins, result.draws,
+                     result.second_wins, result.games_per_second))
+        if args.scaling:
+            worker_counts = list(range(1, args.processes + 1))
+            for workers, rate, efficiency in tournament.scaling(computer, 'random', args.games,
+                                                                worker_counts):
+                print("%-8s vs random   %2d workers: %10.0f games/s  efficiency %5.1f%%"
+                      % (computer, workers, rate, 100 * efficiency))
+
+if __name__ == '__main__':
+    main()
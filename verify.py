@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+from typing import Optional, List, Tuple, NamedTuple, Iterator
+from collections import OrderedDict
+
+import argparse
+import itertools
+import multiprocessing
+import os
+import time
+
+from tictactoe import Grid, PerfectPlayTable
+from tournament import Tournament
+
+class VerificationResult(NamedTuple):
+    checked: int
+    counterexamples: List[Tuple[str, str, int]]  # (grid, mark to move, move played)
+    seconds: float
+    @property
+    def positions_per_second(self) -> float:
+        return self.checked / self.seconds if self.seconds else 0.0
+
+class PositionVerifier:
+    '''Checks a named policy (see Tournament.policies) in every reachable position,
+       sharding the positions across a process pool. A counterexample is a move
+       after which the opponent can force a win, when the position was not lost.'''
+    def __init__(self, processes: Optional[int] = None, chunk_size: int = 250) -> None:
+        self.processes = processes or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+    @staticmethod
+    def iter_positions(markers: str = "XO", unique: bool = False,
+                       finished: bool = True) -> Iterator[Grid]:
+        '''Lazily yields a fresh Grid for each legal reachable position, once each;
+           with unique, only one of each set of symmetric positions is yielded.'''
+        seen = set()  # type: set
+        grid = Grid(markers)
+        def walk() -> Iterator[Grid]:
+            grid_s = grid.get_grid()
+            key = PerfectPlayTable.canonical(grid_s) if unique else grid_s
+            if key in seen:
+                return
+            seen.add(key)
+            over = grid.get_winning_player() is not None or grid.is_full()
+            if finished or not over:
+                copy = Grid(markers)
+                for position in grid.played_positions:  # In play order
+                    copy.play(position)
+                yield copy
+            if over:
+                return
+            for idx in range(9):
+                if grid.play_index(idx) is not None:
+                    yield from walk()
+                    grid.undo()
+        return walk()
+    @staticmethod
+    def _grid_from_string(grid_s: str, markers: str) -> Grid:
+        grid = Grid(markers)
+        cells = [[idx for idx, entry in enumerate(grid_s) if entry == marker] for marker in markers]
+        for idx in itertools.chain.from_iterable(itertools.zip_longest(*cells)):
+            if idx is not None:
+                grid.play(Grid.textual_positions[idx])
+        return grid
+    @classmethod
+    def _verify_chunk(cls, chunk: Tuple[str, str, List[str], bool]
+                      ) -> Tuple[int, List[Tuple[str, str, int]]]:
+        policy_name, markers, positions, orient = chunk
+        if orient:  # Policies need not play symmetrically, so check every orientation
+            positions = list(OrderedDict.fromkeys(PerfectPlayTable._orient(grid_s, perm)
+                                                  for grid_s in positions
+                                                  for perm in PerfectPlayTable.symmetries))
+        policy = Tournament.policies[policy_name](0)
+        counterexamples = []
+        for grid_s in positions:
+            grid = cls._grid_from_string(grid_s, markers)
+            with_mark, vs_mark = (markers if grid_s.count(" ") % 2 else markers[::-1])
+            if PerfectPlayTable.outcome(grid_s, with_mark, vs_mark) < 0:
+                continue  # Already lost; any move will do
+            policy.play_on_grid(grid, with_mark, vs_mark)
+            played = [idx for idx, (old, new) in enumerate(zip(grid_s, grid.get_grid())) if old != new]
+            if len(played) != 1 or PerfectPlayTable.move_outcome(grid_s, with_mark, vs_mark, played[0]) < 0:
+                counterexamples.append((grid_s, with_mark, played[0] if len(played) == 1 else -1))
+        return len(positions), counterexamples
+    def verify(self, policy: str, markers: str = "XO", unique: bool = False,
+               processes: Optional[int] = None) -> VerificationResult:
+        '''Checks policy in every position with a move to make; counterexamples are sorted.
+           With unique, only one position of each symmetry class is enumerated and sent
+           to the workers, which play the policy in each of its orientations.'''
+        if policy not in Tournament.policies:
+            raise ValueError("Unknown policy %r" % policy)
+        positions = (grid.get_grid() for grid in self.iter_positions(markers, unique, finished=False))
+        chunks = iter(lambda: (policy, markers, list(itertools.islice(positions, self.chunk_size)),
+                               unique), (policy, markers, [], unique))
+        start_time = time.perf_counter()
+        checked = 0
+        counterexamples = []  # type: List[Tuple[str, str, int]]
+        with multiprocessing.Pool(processes or self.processes) as pool:
+            for chunk_checked, found in pool.imap_unordered(self._verify_chunk, chunks):
+                checked += chunk_checked
+                counterexamples.extend(found)
+        return VerificationResult(checked, sorted(counterexamples), time.perf_counter() - start_time)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Check a policy in every reachable position.")
+    parser.add_argument("--policy", action="append", choices=sorted(Tournament.policies),
+                        help="policy to verify (default 'computer'); may be repeated")
+    parser.add_argument("--markers", default="XO")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-size", type=int, default=250)
+    parser.add_argument("--unique", action="store_true",
+                        help="enumerate one position per symmetry class, checking each orientation")
+    args = parser.parse_args()
+
+    verifier = PositionVerifier(args.processes, args.chunk_size)
+    for policy in args.policy or ['computer']:
+        result = verifier.verify(policy, args.markers, unique=args.unique)
+        print("%-8s %6d positions: %4d counterexamples  %10.0f positions/s"
+              % (policy, result.checked, len(result.counterexamples), result.positions_per_second))
+        for grid_s, with_mark, move in result.counterexamples:
+            print("  %s plays %s in %r" % (with_mark, move, grid_s))
+
+if __name__ == '__main__':
+    main()